@@ -1,14 +1,23 @@
-from flask import Flask, jsonify, request, render_template, send_from_directory
+from flask import Flask, g, jsonify, request, render_template, send_from_directory, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta, timezone
 import os
 import json
+import queue
+import base64
+import hashlib
+import importlib
 import logging
-from azure.identity import DefaultAzureCredential, AzureCliCredential, ClientSecretCredential
-from azure.mgmt.resource import SubscriptionClient
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.network import NetworkManagementClient
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import HttpResponseError
+from azure.core.pipeline.policies import SansIOHTTPPolicy
 from flask_cors import CORS
+from flask_compress import Compress
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -36,8 +45,32 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Requested-With')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
     response.headers.add('Access-Control-Allow-Credentials', 'true')
+    response.headers.add('Access-Control-Expose-Headers', 'X-Cache-Stale,X-Cache-As-Of,X-Partial-Subscriptions,X-Refresh-Job-Id,X-Next-Cursor,X-Azure-Credential')
+    # Streamed responses have no length up front and are not sized
+    if not response.is_streamed:
+        RESPONSE_SIZE.labels(request.endpoint or 'unknown').observe(response.calculate_content_length() or 0)
+    # Set when cached data was served without a credential to refresh it
+    if g.pop('credential_unavailable', False):
+        response.headers['X-Azure-Credential'] = 'unavailable'
+    if g.pop('vary_accept', False):
+        response.vary.add('Accept')
+    # Registered before Compress, so this runs after it and caches the body as sent
+    cache_key = g.pop('query_cache_key', None)
+    if cache_key and response.status_code == 200 and not response.is_streamed and response.headers.get('X-Cache-Stale') == 'false':
+        store_query_response(cache_key, response)
     return response
 
+# Compress JSON and NDJSON API responses (gzip, brotli, zstd) when the client accepts it
+app.config['COMPRESS_MIMETYPES'] = [
+    'application/json',
+    'application/x-ndjson',
+    'text/html',
+    'text/css',
+    'application/javascript',
+]
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+Compress(app)
+
 # Database configuration from environment
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI', 'sqlite:///azure_cache.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -47,73 +80,525 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'default-dev-key')
 VM_CACHE_DURATION = timedelta(minutes=int(os.getenv('VM_CACHE_DURATION_MINUTES', 5)))
 SUBSCRIPTION_CACHE_DURATION = timedelta(hours=int(os.getenv('SUBSCRIPTION_CACHE_DURATION_HOURS', 1)))
 
+# Background refresh configuration; by default subscriptions are re-crawled
+# at 80% of VM_CACHE_DURATION so requests rarely see an expired cache
+BACKGROUND_REFRESH_ENABLED = os.getenv('BACKGROUND_REFRESH_ENABLED', 'true').lower() == 'true'
+VM_REFRESH_INTERVAL = timedelta(seconds=int(os.getenv('VM_REFRESH_INTERVAL_SECONDS', VM_CACHE_DURATION.total_seconds() * 0.8)))
+REFRESH_JOB_HISTORY = int(os.getenv('REFRESH_JOB_HISTORY', 100))
+
+# Incremental sync configuration; between full crawls only resources reported
+# by Resource Graph change tracking since the last sync are re-read
+DELTA_SYNC_ENABLED = os.getenv('DELTA_SYNC_ENABLED', 'true').lower() == 'true'
+FULL_SYNC_INTERVAL = timedelta(hours=int(os.getenv('FULL_SYNC_INTERVAL_HOURS', 24)))
+# Re-read changes this far behind the watermark to absorb Resource Graph ingestion delay
+DELTA_SYNC_OVERLAP = timedelta(seconds=int(os.getenv('DELTA_SYNC_OVERLAP_SECONDS', 300)))
+
+# VM history configuration; counts per location, power state and size are kept
+# hourly, downsampled to daily, and VM state changes are logged individually
+KPI_HISTORY_HOURLY_RETENTION = timedelta(days=int(os.getenv('KPI_HISTORY_HOURLY_RETENTION_DAYS', 14)))
+KPI_HISTORY_DAILY_RETENTION = timedelta(days=int(os.getenv('KPI_HISTORY_DAILY_RETENTION_DAYS', 400)))
+VM_HISTORY_RETENTION = timedelta(days=int(os.getenv('VM_HISTORY_RETENTION_DAYS', 90)))
+
+# SQLite only: how long a writer waits for another writer's lock
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT_SECONDS', 30))
+
+# Paths each production worker requests before accepting traffic (see warm_up)
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', 'true').lower() == 'true'
+WARMUP_PATHS = [path for path in os.getenv('WARMUP_PATHS', '/api/vms,/api/kpi').split(',') if path]
+
+# Rows fetched from the database at a time when streaming /api/vms
+VM_STREAM_BATCH_SIZE = int(os.getenv('VM_STREAM_BATCH_SIZE', 500))
+
+# Query cache configuration; rendered /api/vms responses are kept in process
+# memory, or in Redis when QUERY_CACHE_REDIS_URL is set so that web workers and
+# a separate refresh-worker share entries and invalidations
+QUERY_CACHE_ENABLED = os.getenv('QUERY_CACHE_ENABLED', 'true').lower() == 'true'
+QUERY_CACHE_MAX_BYTES = int(os.getenv('QUERY_CACHE_MAX_MB', 64)) * 1024 * 1024
+QUERY_CACHE_REDIS_URL = os.getenv('QUERY_CACHE_REDIS_URL')
+
+# Server-sent events configuration; syncs push changed VMs and KPI counts to
+# open /api/events streams. A stream that falls EVENT_STREAM_QUEUE_SIZE events
+# behind, or a sync that changes more than EVENT_STREAM_MAX_CHANGES VMs, makes
+# the page reload instead.
+EVENT_STREAM_QUEUE_SIZE = int(os.getenv('EVENT_STREAM_QUEUE_SIZE', 100))
+EVENT_STREAM_MAX_CHANGES = int(os.getenv('EVENT_STREAM_MAX_CHANGES', 1000))
+EVENT_STREAM_KEEPALIVE = int(os.getenv('EVENT_STREAM_KEEPALIVE_SECONDS', 15))
+# Each open stream holds a server thread; past this many per process, pages are
+# told to poll (503 with Retry-After) so streams can't starve regular requests.
+# Keep it well below GUNICORN_THREADS.
+EVENT_STREAM_MAX_LISTENERS = int(os.getenv('EVENT_STREAM_MAX_LISTENERS', 16))
+EVENT_STREAM_RETRY_AFTER = int(os.getenv('EVENT_STREAM_RETRY_AFTER_SECONDS', 30))
+# Relays events between processes (web workers, refresh-worker) through Redis
+EVENT_STREAM_REDIS_URL = os.getenv('EVENT_STREAM_REDIS_URL', QUERY_CACHE_REDIS_URL)
+
+# Azure concurrency configuration
+AZURE_MAX_CONCURRENCY = int(os.getenv('AZURE_MAX_CONCURRENCY', 8))
+# Retries of each HTTP request by the SDK's RetryPolicy, which honours Retry-After on 429s
+AZURE_MAX_RETRIES = int(os.getenv('AZURE_MAX_RETRIES', 5))
+AZURE_MAX_RETRY_DELAY = int(os.getenv('AZURE_MAX_RETRY_DELAY_SECONDS', 60))
+
+# Client-side ARM rate limiting: every HTTP request, list pages and SDK retries
+# included, takes a token from its scope's bucket, sized like ARM's own quotas:
+# one bucket per subscription, one for tenant-level calls and one for Resource
+# Graph queries. Buckets slow down once ARM's x-ms-ratelimit-remaining-*
+# headers fall to the reserve and pause for Retry-After on a 429.
+ARM_RATE_LIMIT_ENABLED = os.getenv('ARM_RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+ARM_RATE_LIMITS = {
+    'subscription': (float(os.getenv('ARM_SUBSCRIPTION_READS_PER_SECOND', 25)), int(os.getenv('ARM_SUBSCRIPTION_READ_BURST', 250))),
+    'tenant': (float(os.getenv('ARM_TENANT_READS_PER_SECOND', 25)), int(os.getenv('ARM_TENANT_READ_BURST', 250))),
+    'resource_graph': (float(os.getenv('RESOURCE_GRAPH_QUERIES_PER_SECOND', 3)), int(os.getenv('RESOURCE_GRAPH_QUERY_BURST', 15))),
+}
+# Share of a bucket's burst left to other clients of the same quota
+ARM_RATE_LIMIT_RESERVE = int(os.getenv('ARM_RATE_LIMIT_RESERVE_PERCENT', 10)) / 100
+# Errors kept per subscription sync for /api/refresh-jobs
+SYNC_ERROR_LIMIT = int(os.getenv('SYNC_ERROR_LIMIT', 20))
+
+# Caps in-flight ARM calls per process, across its requests and threads; each
+# gunicorn worker and the refresh-worker has its own cap
+arm_semaphore = threading.BoundedSemaphore(AZURE_MAX_CONCURRENCY)
+subscription_executor = ThreadPoolExecutor(max_workers=AZURE_MAX_CONCURRENCY, thread_name_prefix='azure-subscription')
+list_executor = ThreadPoolExecutor(max_workers=AZURE_MAX_CONCURRENCY, thread_name_prefix='azure-list')
+
+# Prometheus metrics, served from /metrics
+ARM_REQUESTS = Counter('azboard_arm_requests_total', 'ARM operations by operation and HTTP status', ['operation', 'status'])
+ARM_REQUEST_DURATION = Histogram('azboard_arm_request_duration_seconds', 'ARM operation duration, including all pages of a listing', ['operation'])
+ARM_RATE_LIMIT_WAIT = Histogram('azboard_arm_rate_limit_wait_seconds', 'Time ARM requests waited for a rate limit token, by bucket kind', ['kind'])
+ARM_QUOTA_REMAINING = Gauge('azboard_arm_quota_remaining', 'Remaining ARM quota last reported by x-ms-ratelimit-remaining-* headers, by scope', ['scope'])
+ARM_THROTTLED = Counter('azboard_arm_throttled_total', 'HTTP 429 responses from ARM, by bucket kind', ['kind'])
+SYNC_DURATION = Histogram(
+    'azboard_sync_duration_seconds', 'Subscription sync duration', ['subscription_id', 'mode'],
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
+SYNC_FAILURES = Counter('azboard_sync_failures_total', 'Failed subscription syncs', ['subscription_id', 'mode'])
+SYNC_FALLBACKS = Counter('azboard_sync_fallbacks_total', 'Delta syncs run as a full crawl because the Resource Graph change query failed', ['subscription_id'])
+VM_CACHE_LOOKUPS = Counter('azboard_vm_cache_lookups_total', 'VMCache lookups per subscription by result (hit, miss, expired)', ['result'])
+DB_WRITE_DURATION = Histogram('azboard_db_write_duration_seconds', 'Time spent writing a sync to the database, commit included', ['operation'])
+EVENT_STREAM_LISTENERS = Gauge('azboard_event_stream_listeners', 'Open /api/events streams')
+EVENTS_PUBLISHED = Counter('azboard_events_published_total', 'Events published to /api/events streams by event', ['event'])
+QUERY_CACHE_LOOKUPS = Counter('azboard_query_cache_lookups_total', '/api/vms query cache lookups by result (hit, miss)', ['result'])
+RESPONSE_SIZE = Histogram(
+    'azboard_response_size_bytes', 'Response body size as sent, by endpoint', ['endpoint'],
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+)
+
 db = SQLAlchemy(app)
 
 # Database Models
 class VMCache(db.Model):
     id = db.Column(db.String(200), primary_key=True)
-    subscription_id = db.Column(db.String(100))
+    subscription_id = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(200))
+    resource_group = db.Column(db.String(100))
+    location = db.Column(db.String(100))
+    vm_size = db.Column(db.String(100))
+    status = db.Column(db.String(100))
+    os_type = db.Column(db.String(50))
+    data = db.Column(db.Text)
+    last_updated = db.Column(db.DateTime(timezone=True), default=datetime.now(timezone.utc), index=True)
+
+    # Filters are case-insensitive, so index the lowered values per subscription
+    __table_args__ = (
+        db.Index('ix_vm_cache_subscription_name', subscription_id, name),
+        db.Index('ix_vm_cache_subscription_resource_group', subscription_id, db.func.lower(resource_group)),
+        db.Index('ix_vm_cache_subscription_location', subscription_id, db.func.lower(location)),
+        db.Index('ix_vm_cache_subscription_vm_size', subscription_id, db.func.lower(vm_size)),
+        db.Index('ix_vm_cache_subscription_status', subscription_id, db.func.lower(status)),
+    )
+
+class VMSyncState(db.Model):
+    subscription_id = db.Column(db.String(100), primary_key=True)
+    last_synced = db.Column(db.DateTime(timezone=True))
+    last_full_sync = db.Column(db.DateTime(timezone=True))
+    # Reads the last sync skipped (a VM, a NIC, an inventory listing), which
+    # left part of the subscription as of an earlier sync; the first
+    # SYNC_ERROR_LIMIT messages are kept as a JSON list
+    error_count = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Text)
+
+# VM counts per subscription and dimension ('power', 'region', 'size'),
+# rewritten whenever a subscription's VMCache rows are
+class KPIAggregate(db.Model):
+    subscription_id = db.Column(db.String(100), primary_key=True)
+    dimension = db.Column(db.String(20), primary_key=True)
+    key = db.Column(db.String(100), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    last_updated = db.Column(db.DateTime(timezone=True), default=datetime.now(timezone.utc))
+
+# VM counts per subscription and power state by location and by size
+# (dimension 'location' or 'vm_size', key the location or size) as of the last
+# sync in each hour ('hour') and day ('day'), for /api/kpi/history and
+# /api/kpi/trend. Each dimension alone sums to the subscription's total.
+class KPIHistory(db.Model):
+    resolution = db.Column(db.String(10), primary_key=True)
+    dimension = db.Column(db.String(20), primary_key=True)
+    bucket_start = db.Column(db.DateTime(timezone=True), primary_key=True)
+    subscription_id = db.Column(db.String(100), primary_key=True)
+    key = db.Column(db.String(100), primary_key=True)
+    power = db.Column(db.String(20), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+    # Stored in primary key order on SQLite, so a range of buckets is one sequential read
+    __table_args__ = {'sqlite_with_rowid': False}
+
+# Append-only log of VMs created, deleted or changed in power state, size or
+# location, one row per change found by a sync
+class VMStateChange(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    vm_id = db.Column(db.String(200), nullable=False)
+    subscription_id = db.Column(db.String(100), nullable=False)
+    changed_at = db.Column(db.DateTime(timezone=True), nullable=False)
+    change_type = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(100))
+    vm_size = db.Column(db.String(100))
+    location = db.Column(db.String(100))
+
+    __table_args__ = (
+        db.Index('ix_vm_state_change_vm', vm_id, changed_at),
+        db.Index('ix_vm_state_change_subscription', subscription_id, changed_at),
+    )
+
+# Network and storage resources listed by the same crawl as VMCache, stored
+# in the shape the network and storage pages render. vm_id joins NICs, public
+# IPs and disks to VMCache.id (lowercased).
+class InventoryCache(db.Model):
+    id = db.Column(db.String(300), primary_key=True)
+    subscription_id = db.Column(db.String(100), nullable=False)
+    resource_type = db.Column(db.String(50), nullable=False)
+    name = db.Column(db.String(200))
     resource_group = db.Column(db.String(100))
+    location = db.Column(db.String(100))
+    vm_id = db.Column(db.String(300), index=True)
     data = db.Column(db.Text)
     last_updated = db.Column(db.DateTime(timezone=True), default=datetime.now(timezone.utc))
 
+    __table_args__ = (
+        db.Index('ix_inventory_cache_subscription_type', subscription_id, resource_type, name),
+    )
+
 class SubscriptionCache(db.Model):
     id = db.Column(db.String(100), primary_key=True)
     display_name = db.Column(db.String(200))
     state = db.Column(db.String(50))
     last_updated = db.Column(db.DateTime(timezone=True), default=datetime.now(timezone.utc))
 
-# Create tables
-with app.app_context():
+def create_cache_schema():
+    # The tables only hold cached Azure data, so a table whose columns no
+    # longer match its model is dropped and rebuilt by the next crawl
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        if existing != set(table.columns.keys()):
+            app.logger.warning(f"Rebuilding cache table {table.name} for the current schema")
+            table.drop(db.engine)
     db.create_all()
 
-def get_azure_credential():
-    try:
-        # Try DefaultAzureCredential first
-        credential = DefaultAzureCredential()
-        # Test the credential
-        token = credential.get_token("https://management.azure.com/.default")
-        if token:
-            return credential
-    except Exception as e:
-        app.logger.error(f"Error getting DefaultAzureCredential: {str(e)}")
-        pass
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    # WAL lets the API read the last committed snapshot while a refresh writes
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT * 1000}")
+    cursor.close()
 
-    try:
-        # Try AzureCliCredential as fallback
-        credential = AzureCliCredential()
-        # Test the credential
-        token = credential.get_token("https://management.azure.com/.default")
-        if token:
-            return credential
-    except Exception as e:
-        app.logger.error(f"Error getting AzureCliCredential: {str(e)}")
-        pass
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        db.event.listen(db.engine, 'connect', configure_sqlite_connection)
 
-    return None
+# Tables are created by `flask init-db` (or gunicorn's on_starting hook), not at
+# import, so workers and CLI commands don't inspect the schema on every start
+@app.cli.command('init-db')
+def init_db():
+    create_cache_schema()
+    app.logger.info("Cache schema is up to date")
 
-def get_subscriptions():
-    try:
-        app.logger.info("Fetching subscriptions...")
-        credential = get_azure_credential()
+# The Azure SDK packages take most of the import time, so their classes are
+# imported on first use. A module global of the same name (set by fake_azure)
+# takes precedence.
+AZURE_CLASSES = {
+    'DefaultAzureCredential': 'azure.identity',
+    'AzureCliCredential': 'azure.identity',
+    'SubscriptionClient': 'azure.mgmt.resource',
+    'ComputeManagementClient': 'azure.mgmt.compute',
+    'NetworkManagementClient': 'azure.mgmt.network',
+    'StorageManagementClient': 'azure.mgmt.storage',
+    'ResourceGraphClient': 'azure.mgmt.resourcegraph',
+    'QueryRequest': 'azure.mgmt.resourcegraph.models',
+    'QueryRequestOptions': 'azure.mgmt.resourcegraph.models',
+}
+
+def azure_class(name):
+    cls = globals().get(name)
+    if cls is None:
+        cls = globals()[name] = getattr(importlib.import_module(AZURE_CLASSES[name]), name)
+    return cls
+
+ARM_SCOPE = "https://management.azure.com/.default"
+# Refresh cached tokens this long before they expire
+TOKEN_REFRESH_MARGIN = int(os.getenv('AZURE_TOKEN_REFRESH_MARGIN_SECONDS', 300))
+
+# Wraps an azure-identity credential and reuses its tokens until they near expiry.
+# AzureCliCredential spawns an `az` subprocess on every get_token call otherwise.
+class CachedTokenCredential:
+    def __init__(self, credential):
+        self.credential = credential
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, **kwargs):
+        # Claims challenges (CAE) must always reach the underlying credential
+        if kwargs.get('claims'):
+            return self.credential.get_token(*scopes, **kwargs)
+
+        key = (scopes, kwargs.get('tenant_id'))
+        with self._lock:
+            token = self._tokens.get(key)
+            if token is None or token.expires_on - time.time() < TOKEN_REFRESH_MARGIN:
+                token = self.credential.get_token(*scopes, **kwargs)
+                self._tokens[key] = token
+            return token
+
+    def close(self):
+        if hasattr(self.credential, 'close'):
+            self.credential.close()
+
+# Process-wide credential, probed once and reused by every request and worker
+class CredentialHolder:
+    def __init__(self):
+        self._credential = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        # Probing happens under the lock so concurrent requests share one attempt
+        with self._lock:
+            if self._credential is not None:
+                try:
+                    # Served from the token cache until the token nears expiry
+                    self._credential.get_token(ARM_SCOPE)
+                    return self._credential
+                except Exception as e:
+                    app.logger.warning(f"Cached Azure credential is no longer valid: {str(e)}")
+                    self._credential = None
+
+            self._credential = self._probe()
+            return self._credential
+
+    def reset(self):
+        with self._lock:
+            if self._credential is not None:
+                self._credential.close()
+            self._credential = None
+
+    def _probe(self):
+        try:
+            # Try DefaultAzureCredential first
+            credential = CachedTokenCredential(azure_class('DefaultAzureCredential')())
+            # Test the credential
+            token = credential.get_token(ARM_SCOPE)
+            if token:
+                return credential
+        except Exception as e:
+            app.logger.error(f"Error getting DefaultAzureCredential: {str(e)}")
+
+        try:
+            # Try AzureCliCredential as fallback
+            credential = CachedTokenCredential(azure_class('AzureCliCredential')())
+            # Test the credential
+            token = credential.get_token(ARM_SCOPE)
+            if token:
+                return credential
+        except Exception as e:
+            app.logger.error(f"Error getting AzureCliCredential: {str(e)}")
+
+        return None
+
+# Management clients keyed by (client class, subscription) so HTTP connections are reused
+class AzureClientPool:
+    def __init__(self, credential_holder):
+        self.credential_holder = credential_holder
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, client_class, subscription_id=None, quota_scope='tenant'):
+        # quota_scope names the rate limit bucket of clients not bound to a subscription
+        credential = self.credential_holder.get()
         if not credential:
-            app.logger.error("No valid Azure credential found")
-            return []
-            
-        subscription_client = SubscriptionClient(credential)
+            raise Exception("Failed to get Azure credentials")
+
+        key = (client_class, subscription_id)
+        with self._lock:
+            entry = self._clients.get(key)
+        # Clients built for a credential that has since been replaced are rebuilt
+        if entry is not None and entry[0] is credential:
+            return entry[1]
+
+        # Built outside the lock so subscriptions being fanned out don't queue on each other
+        args = (credential, subscription_id) if subscription_id else (credential,)
+        client = client_class(
+            *args,
+            retry_total=AZURE_MAX_RETRIES,
+            retry_backoff_max=AZURE_MAX_RETRY_DELAY,
+            per_retry_policies=[ArmRateLimitPolicy(subscription_id or quota_scope)]
+        )
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is None or entry[0] is not credential:
+                entry = self._clients[key] = (credential, client)
+        if entry[1] is not client:
+            # Another thread won the race; keep its client
+            client.close()
+        return entry[1]
+
+    def clear(self):
+        with self._lock:
+            clients = [client for _, client in self._clients.values()]
+            self._clients.clear()
+        for client in clients:
+            try:
+                client.close()
+            except Exception as e:
+                app.logger.warning(f"Error closing Azure client: {str(e)}")
+
+credential_holder = CredentialHolder()
+client_pool = AzureClientPool(credential_holder)
+
+def get_azure_credential():
+    return credential_holder.get()
+
+def get_compute_client(subscription_id):
+    return client_pool.get(azure_class('ComputeManagementClient'), subscription_id)
+
+def get_network_client(subscription_id):
+    return client_pool.get(azure_class('NetworkManagementClient'), subscription_id)
+
+def get_subscription_client():
+    return client_pool.get(azure_class('SubscriptionClient'))
+
+def get_resource_graph_client():
+    return client_pool.get(azure_class('ResourceGraphClient'), quota_scope='resource_graph')
+
+def get_storage_client(subscription_id):
+    return client_pool.get(azure_class('StorageManagementClient'), subscription_id)
+
+def fetch_subscriptions():
+    app.logger.info("Fetching subscriptions...")
+    # Raised rather than returning an empty listing, so SubscriptionStore falls
+    # back to the last listing it saved
+    credential = get_azure_credential()
+    if not credential:
+        raise Exception("No valid Azure credential found")
         
-        subscriptions = []
-        for sub in subscription_client.subscriptions.list():
-            app.logger.info(f"Found subscription: {sub.display_name} ({sub.subscription_id})")
-            subscriptions.append({
-                'id': sub.subscription_id,
-                'display_name': sub.display_name
-            })
-            
-        if not subscriptions:
-            app.logger.warning("No subscriptions found")
-            
-        return subscriptions
+    subscription_client = get_subscription_client()
+    
+    subscriptions = []
+    for sub in call_arm('subscriptions.list', lambda: list(subscription_client.subscriptions.list())):
+        app.logger.info(f"Found subscription: {sub.display_name} ({sub.subscription_id})")
+        subscriptions.append({
+            'id': sub.subscription_id,
+            'display_name': sub.display_name,
+            'state': getattr(sub.state, 'value', sub.state)
+        })
+        
+    if not subscriptions:
+        app.logger.warning("No subscriptions found")
+        
+    return subscriptions
+
+# Subscription listing cached in memory (L1) in front of SubscriptionCache (L2).
+# Loads are single-flighted: concurrent requests on a cold cache wait for the
+# one ARM call instead of issuing their own.
+class SubscriptionStore:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._subscriptions = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def get(self, force_refresh=False):
+        subscriptions = None if force_refresh else self._from_memory()
+        if subscriptions is not None:
+            return subscriptions
+
+        loaded_at = self._loaded_at
+        with self._lock:
+            # Another request may have finished loading while we waited
+            if self._loaded_at != loaded_at:
+                subscriptions = self._from_memory()
+                if subscriptions is not None:
+                    return subscriptions
+
+            if not force_refresh:
+                subscriptions, last_updated = self._from_database()
+                if subscriptions:
+                    self._remember(subscriptions, last_updated)
+                    return list(subscriptions)
+
+            try:
+                subscriptions = fetch_subscriptions()
+            except Exception as e:
+                app.logger.error(f"Error fetching subscriptions: {str(e)}")
+                # Fall back to an expired listing rather than showing nothing
+                subscriptions, _ = self._from_database(include_expired=True)
+                return subscriptions
+
+            # Same order as listings read back from SubscriptionCache
+            subscriptions.sort(key=lambda sub: sub['display_name'] or '')
+            # An empty listing usually means we aren't logged in yet, so don't pin it
+            if subscriptions:
+                self._save(subscriptions)
+            return list(subscriptions)
+
+    def clear(self):
+        with self._lock:
+            self._subscriptions = None
+            self._loaded_at = None
+
+    def _from_memory(self):
+        subscriptions, loaded_at = self._subscriptions, self._loaded_at
+        if subscriptions is None or is_cache_expired(loaded_at, self.ttl):
+            return None
+        return list(subscriptions)
+
+    def _from_database(self, include_expired=False):
+        rows = SubscriptionCache.query.order_by(SubscriptionCache.display_name).all()
+        if not rows:
+            return [], None
+        last_updated = min(as_utc(row.last_updated) for row in rows)
+        if not include_expired and is_cache_expired(last_updated, self.ttl):
+            return [], None
+        subscriptions = [
+            {'id': row.id, 'display_name': row.display_name, 'state': row.state}
+            for row in rows
+        ]
+        return subscriptions, last_updated
+
+    def _save(self, subscriptions):
+        now = datetime.now(timezone.utc)
+        try:
+            SubscriptionCache.query.delete()
+            for sub in subscriptions:
+                db.session.add(SubscriptionCache(
+                    id=sub['id'],
+                    display_name=sub['display_name'],
+                    state=sub['state'],
+                    last_updated=now
+                ))
+            db.session.commit()
+        except Exception as e:
+            app.logger.error(f"Error caching subscriptions: {str(e)}")
+            db.session.rollback()
+        self._remember(subscriptions, now)
+
+    def _remember(self, subscriptions, loaded_at):
+        self._subscriptions = list(subscriptions)
+        self._loaded_at = loaded_at
+
+subscription_store = SubscriptionStore(SUBSCRIPTION_CACHE_DURATION)
+
+def get_subscriptions(force_refresh=False):
+    try:
+        return subscription_store.get(force_refresh)
     except Exception as e:
         app.logger.error(f"Error fetching subscriptions: {str(e)}")
         return []
@@ -124,77 +609,995 @@ def get_azure_clients():
         if not credential:
             raise Exception("Failed to get Azure credentials")
             
-        subscription_client = SubscriptionClient(credential)
+        subscription_client = get_subscription_client()
         return credential, subscription_client
     except Exception as e:
         app.logger.error(f"Error getting Azure clients: {str(e)}")
         return None, None
 
+def as_utc(value):
+    # SQLite hands back naive datetimes even for timezone-aware columns
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
 def is_cache_expired(last_updated, cache_duration):
-    return datetime.now(timezone.utc) - last_updated > cache_duration
+    return datetime.now(timezone.utc) - as_utc(last_updated) > cache_duration
 
-def fetch_and_cache_vms(compute_client, subscription_id):
-    vms = []
+def parse_retry_after(headers):
+    retry_after = headers.get('Retry-After')
+    if retry_after is None and headers.get('x-ms-retry-after-ms'):
+        retry_after = float(headers['x-ms-retry-after-ms']) / 1000
     try:
-        for vm in compute_client.virtual_machines.list_all():
+        return min(float(retry_after), AZURE_MAX_RETRY_DELAY)
+    except (TypeError, ValueError):
+        return None
+
+def parse_remaining_quota(headers):
+    # Lowest remaining count among ARM's x-ms-ratelimit-remaining-* read
+    # headers (e.g. 'x-ms-ratelimit-remaining-subscription-reads: 11999' or
+    # 'x-ms-ratelimit-remaining-resource: Microsoft.Compute/HighCostGet3Min;107,...'),
+    # split into the request's own scope and the tenant. Resource Graph reports
+    # its quota as x-ms-user-quota-remaining.
+    remaining = {}
+    for name, value in headers.items():
+        name = name.lower()
+        if name == 'x-ms-user-quota-remaining':
+            scope = 'own'
+        elif name.startswith('x-ms-ratelimit-remaining-') and not name.endswith(('-writes', '-deletes')):
+            scope = 'tenant' if name.startswith('x-ms-ratelimit-remaining-tenant-') else 'own'
+        else:
+            continue
+        for part in value.split(','):
             try:
-                vm_instance = compute_client.virtual_machines.get(
-                    vm.id.split('/')[4],
-                    vm.name,
-                    expand='instanceView'
-                )
-                
-                # Get network interface info
-                network_info = []
-                for nic_ref in vm.network_profile.network_interfaces:
-                    nic_name = nic_ref.id.split('/')[-1]
-                    resource_group = nic_ref.id.split('/')[4]
-                    try:
-                        nic = NetworkManagementClient(get_azure_credential(), subscription_id).network_interfaces.get(resource_group, nic_name)
-                        for ip_config in nic.ip_configurations:
-                            network_info.append({
-                                'private_ip': ip_config.private_ip_address,
-                                'public_ip': ip_config.public_ip_address.ip_address if ip_config.public_ip_address else None,
-                                'subnet': ip_config.subnet.id.split('/')[-1] if ip_config.subnet else None
-                            })
-                    except Exception as e:
-                        app.logger.error(f"Error fetching network info: {str(e)}")
-                        network_info.append({'error': 'Failed to fetch network information'})
-
-                vm_data = {
-                    'id': vm.id,
-                    'name': vm.name,
-                    'resource_group': vm.id.split('/')[4],
-                    'location': vm.location,
-                    'vm_size': vm.hardware_profile.vm_size,
-                    'os_type': vm.storage_profile.os_disk.os_type,
-                    'status': next((status.display_status for status in vm_instance.instance_view.statuses if status.code.startswith('PowerState/')), 'unknown'),
-                    'network_info': network_info,
-                    'subscription_id': subscription_id
-                }
-                
-                # Cache each VM separately
-                cache_entry = VMCache(
-                    id=vm.id,
-                    subscription_id=subscription_id,
-                    resource_group=vm_data['resource_group'],
-                    data=json.dumps(vm_data),
-                    last_updated=datetime.now(timezone.utc)
-                )
-                
-                db.session.merge(cache_entry)
-                vms.append(vm_data)
-            except Exception as e:
-                app.logger.error(f"Error processing VM {vm.name}: {str(e)}")
+                count = int(part.rsplit(';', 1)[-1])
+            except ValueError:
                 continue
-                
+            remaining[scope] = min(count, remaining.get(scope, count))
+    return remaining
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.base_rate = self.rate = rate
+        self.burst = burst
+        self.reserve = burst * ARM_RATE_LIMIT_RESERVE
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.slowed_at = 0
+
+    def take(self, now):
+        # Takes a token and returns 0, or returns how long to wait for one
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def observe(self, remaining):
+        # ARM's count is authoritative: never hold more tokens than it has left
+        # above the reserve, so requests wait for its refill instead of running
+        # into a 429. A rate cut by a 429 recovers gradually while there is headroom.
+        self.tokens = min(self.tokens, remaining - self.reserve)
+        if remaining > self.reserve and self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate / 100)
+
+    def throttle(self, now, retry_after):
+        # Halves the rate at most once a second, down to a tenth of the configured rate
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+        self.tokens = min(self.tokens, 0)
+        if now - self.slowed_at >= 1:
+            self.rate = max(self.base_rate / 10, self.rate / 2)
+            self.slowed_at = now
+
+# Token buckets keyed by scope: a subscription ID, 'tenant' or 'resource_graph'.
+# Shared by every thread of the process, so concurrent crawls of the same
+# subscription draw from one bucket.
+class ArmRateLimiter:
+    def __init__(self, limits):
+        self.limits = limits
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def kind(self, scope):
+        return scope if scope in self.limits else 'subscription'
+
+    def _bucket(self, scope):
+        bucket = self._buckets.get(scope)
+        if bucket is None:
+            bucket = self._buckets[scope] = TokenBucket(*self.limits[self.kind(scope)])
+        return bucket
+
+    def acquire(self, scope):
+        waited = 0
+        while True:
+            with self._lock:
+                delay = self._bucket(scope).take(time.monotonic())
+            if delay <= 0:
+                break
+            waited += delay
+            time.sleep(delay)
+        if waited:
+            ARM_RATE_LIMIT_WAIT.labels(self.kind(scope)).observe(waited)
+
+    def observe(self, scope, status_code, headers):
+        remaining = parse_remaining_quota(headers)
+        now = time.monotonic()
+        with self._lock:
+            for quota_scope, count in remaining.items():
+                quota_scope = scope if quota_scope == 'own' else quota_scope
+                self._bucket(quota_scope).observe(count)
+                ARM_QUOTA_REMAINING.labels(quota_scope).set(count)
+            if status_code == 429:
+                retry_after = parse_retry_after(headers)
+                self._bucket(scope).throttle(now, retry_after if retry_after is not None else 1)
+        if status_code == 429:
+            ARM_THROTTLED.labels(self.kind(scope)).inc()
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+arm_rate_limiter = ArmRateLimiter(ARM_RATE_LIMITS)
+
+# Added to every pooled Azure client after the SDK's retry policy, so each HTTP
+# attempt, list page and SDK retry included, reports its quota and 429s and,
+# with ARM_RATE_LIMIT_ENABLED, is paced
+class ArmRateLimitPolicy(SansIOHTTPPolicy):
+    def __init__(self, scope):
+        self.scope = scope
+
+    def on_request(self, request):
+        if ARM_RATE_LIMIT_ENABLED:
+            arm_rate_limiter.acquire(self.scope)
+
+    def on_response(self, request, response):
+        arm_rate_limiter.observe(self.scope, response.http_response.status_code, response.http_response.headers)
+
+def call_arm(operation_name, operation, *args, **kwargs):
+    # Runs an ARM call under the process's concurrency cap. 429s are retried
+    # per HTTP request by the client's RetryPolicy, so one that reaches here
+    # has used up AZURE_MAX_RETRIES. operation_name labels the call in the metrics.
+    with arm_semaphore:
+        started = time.perf_counter()
+        try:
+            result = operation(*args, **kwargs)
+            ARM_REQUESTS.labels(operation_name, '200').inc()
+            return result
+        except HttpResponseError as e:
+            ARM_REQUESTS.labels(operation_name, str(e.status_code)).inc()
+            raise
+        except Exception:
+            ARM_REQUESTS.labels(operation_name, 'error').inc()
+            raise
+        finally:
+            ARM_REQUEST_DURATION.labels(operation_name).observe(time.perf_counter() - started)
+
+def run_with_app_context(func, *args, **kwargs):
+    with app.app_context():
+        return func(*args, **kwargs)
+
+def get_power_states(compute_client):
+    # statusOnly=true returns the instance view of every VM in the subscription
+    # in a few paged calls instead of one GET per VM
+    power_states = {}
+    for vm in call_arm('virtual_machines.list_all_status', lambda: list(compute_client.virtual_machines.list_all(status_only='true'))):
+        instance_view = vm.instance_view
+        statuses = instance_view.statuses if instance_view and instance_view.statuses else []
+        power_states[vm.id.lower()] = next(
+            (status.display_status for status in statuses if status.code and status.code.startswith('PowerState/')),
+            'unknown'
+        )
+    return power_states
+
+def get_network_index(network_client):
+    # Resolve every NIC and public IP of the subscription up front so VMs can be
+    # joined to them in memory by resource ID
+    nics = {nic.id.lower(): nic for nic in call_arm('network_interfaces.list_all', lambda: list(network_client.network_interfaces.list_all()))}
+    public_ips = {ip.id.lower(): ip for ip in call_arm('public_ip_addresses.list_all', lambda: list(network_client.public_ip_addresses.list_all()))}
+    return nics, public_ips
+
+def build_network_info(vm, nics, public_ips):
+    network_info = []
+    for nic_ref in vm.network_profile.network_interfaces if vm.network_profile else []:
+        nic = nics.get(nic_ref.id.lower())
+        if nic is None:
+            app.logger.error(f"Network interface not found: {nic_ref.id}")
+            network_info.append({'error': 'Failed to fetch network information'})
+            continue
+        for ip_config in nic.ip_configurations or []:
+            public_ip = None
+            if ip_config.public_ip_address:
+                public_ip = ip_config.public_ip_address.ip_address
+                if not public_ip and ip_config.public_ip_address.id.lower() in public_ips:
+                    public_ip = public_ips[ip_config.public_ip_address.id.lower()].ip_address
+            network_info.append({
+                'private_ip': ip_config.private_ip_address,
+                'public_ip': public_ip,
+                'subnet': ip_config.subnet.id.split('/')[-1] if ip_config.subnet else None
+            })
+    return network_info
+
+def build_vm_data(vm, subscription_id, power_states, nics, public_ips):
+    return {
+        'id': vm.id,
+        'name': vm.name,
+        'resource_group': vm.id.split('/')[4],
+        'location': vm.location,
+        'vm_size': getattr(vm.hardware_profile.vm_size, 'value', vm.hardware_profile.vm_size),
+        'os_type': getattr(vm.storage_profile.os_disk.os_type, 'value', vm.storage_profile.os_disk.os_type),
+        'status': power_states.get(vm.id.lower(), 'unknown'),
+        'network_info': build_network_info(vm, nics, public_ips),
+        'subscription_id': subscription_id
+    }
+
+# Dialects with INSERT ... ON CONFLICT; others fall back to a merge per row
+UPSERT_DIALECTS = ('sqlite', 'postgresql')
+
+def upsert_rows(model, rows):
+    # Upserts a batch of rows in one executemany instead of a SELECT plus
+    # INSERT/UPDATE per row
+    if not rows:
+        return
+
+    dialect = db.engine.dialect.name
+    if dialect not in UPSERT_DIALECTS:
+        for row in rows:
+            db.session.merge(model(**row))
+        return
+
+    insert = importlib.import_module(f"sqlalchemy.dialects.{dialect}").insert
+    statement = insert(model.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=[model.__table__.c.id],
+        set_={column: statement.excluded[column] for column in rows[0] if column != 'id'}
+    )
+    db.session.execute(statement, rows)
+
+def cache_vms(vms, now):
+    upsert_rows(VMCache, [{
+        'id': vm_data['id'],
+        'subscription_id': vm_data['subscription_id'],
+        'name': vm_data['name'],
+        'resource_group': vm_data['resource_group'],
+        'location': vm_data['location'],
+        'vm_size': vm_data['vm_size'],
+        'status': vm_data['status'],
+        'os_type': vm_data['os_type'],
+        'data': json.dumps(vm_data),
+        'last_updated': now
+    } for vm_data in vms])
+
+def enum_value(value):
+    return getattr(value, 'value', value)
+
+def reference(resource):
+    return {'id': resource.id} if resource else None
+
+def inventory_fields(resource):
+    return {
+        'id': resource.id,
+        'name': resource.name,
+        'resourceGroup': resource.id.split('/')[4],
+        'location': resource.location
+    }
+
+def serialize_virtual_network(vnet):
+    return {
+        **inventory_fields(vnet),
+        'addressSpace': {'addressPrefixes': vnet.address_space.address_prefixes if vnet.address_space else []},
+        'subnets': [{
+            'id': subnet.id,
+            'name': subnet.name,
+            'addressPrefix': subnet.address_prefix or ', '.join(subnet.address_prefixes or []),
+            'networkSecurityGroup': reference(subnet.network_security_group)
+        } for subnet in vnet.subnets or []],
+        'dhcpOptions': {'dnsServers': vnet.dhcp_options.dns_servers if vnet.dhcp_options else None}
+    }
+
+def serialize_network_security_group(nsg):
+    return {
+        **inventory_fields(nsg),
+        'securityRules': [{
+            'name': rule.name,
+            'priority': rule.priority,
+            'access': enum_value(rule.access),
+            'direction': enum_value(rule.direction),
+            'protocol': enum_value(rule.protocol),
+            'sourceAddressPrefix': rule.source_address_prefix,
+            'destinationPortRange': rule.destination_port_range
+        } for rule in nsg.security_rules or []],
+        'subnets': [reference(subnet) for subnet in nsg.subnets or []],
+        'networkInterfaces': [reference(nic) for nic in nsg.network_interfaces or []]
+    }
+
+def serialize_network_interface(nic):
+    return {
+        **inventory_fields(nic),
+        'macAddress': nic.mac_address,
+        'virtualMachine': reference(nic.virtual_machine),
+        'networkSecurityGroup': reference(nic.network_security_group),
+        'ipConfigurations': [{
+            'name': ip_config.name,
+            'privateIPAddress': ip_config.private_ip_address,
+            'publicIPAddress': reference(ip_config.public_ip_address),
+            'subnet': reference(ip_config.subnet)
+        } for ip_config in nic.ip_configurations or []]
+    }
+
+def serialize_public_ip_address(public_ip):
+    return {
+        **inventory_fields(public_ip),
+        'ipAddress': public_ip.ip_address,
+        'sku': {'name': enum_value(public_ip.sku.name) if public_ip.sku else None},
+        'publicIPAllocationMethod': enum_value(public_ip.public_ip_allocation_method),
+        'ipConfiguration': reference(public_ip.ip_configuration)
+    }
+
+def serialize_disk(disk):
+    return {
+        **inventory_fields(disk),
+        'sku': {'name': enum_value(disk.sku.name) if disk.sku else None},
+        'diskSizeGB': disk.disk_size_gb,
+        'diskState': enum_value(disk.disk_state),
+        'osType': enum_value(disk.os_type),
+        'managedBy': disk.managed_by
+    }
+
+def serialize_storage_account(account):
+    endpoints = account.primary_endpoints
+    return {
+        **inventory_fields(account),
+        'sku': {'name': enum_value(account.sku.name) if account.sku else None},
+        'kind': enum_value(account.kind),
+        'accessTier': enum_value(account.access_tier),
+        'statusOfPrimary': enum_value(account.status_of_primary),
+        'primaryEndpoints': {
+            name: getattr(endpoints, name)
+            for name in ('blob', 'queue', 'table', 'file', 'web', 'dfs')
+            if getattr(endpoints, name, None)
+        } if endpoints else None
+    }
+
+# Inventory resource types: (Resource Graph type, serializer)
+INVENTORY_TYPES = {
+    'virtual_network': ('microsoft.network/virtualnetworks', serialize_virtual_network),
+    'network_security_group': ('microsoft.network/networksecuritygroups', serialize_network_security_group),
+    'network_interface': ('microsoft.network/networkinterfaces', serialize_network_interface),
+    'public_ip_address': ('microsoft.network/publicipaddresses', serialize_public_ip_address),
+    'disk': ('microsoft.compute/disks', serialize_disk),
+    'storage_account': ('microsoft.storage/storageaccounts', serialize_storage_account),
+}
+# Types re-listed together by a delta sync, so their VM joins stay consistent
+INVENTORY_GROUPS = {
+    'network': ('virtual_network', 'network_security_group', 'network_interface', 'public_ip_address'),
+    'storage': ('disk', 'storage_account'),
+}
+
+def get_inventory_listings(compute_client, network_client, subscription_id):
+    storage_client = get_storage_client(subscription_id)
+    return {
+        'virtual_network': lambda: call_arm('virtual_networks.list_all', lambda: list(network_client.virtual_networks.list_all())),
+        'network_security_group': lambda: call_arm('network_security_groups.list_all', lambda: list(network_client.network_security_groups.list_all())),
+        'network_interface': lambda: call_arm('network_interfaces.list_all', lambda: list(network_client.network_interfaces.list_all())),
+        'public_ip_address': lambda: call_arm('public_ip_addresses.list_all', lambda: list(network_client.public_ip_addresses.list_all())),
+        'disk': lambda: call_arm('disks.list', lambda: list(compute_client.disks.list())),
+        'storage_account': lambda: call_arm('storage_accounts.list', lambda: list(storage_client.storage_accounts.list()))
+    }
+
+def submit_inventory_listings(listings, resource_types):
+    return {resource_type: list_executor.submit(listings[resource_type]) for resource_type in resource_types}
+
+def collect_inventory(futures, issues):
+    # A type that fails to list keeps its cached snapshot
+    inventory = {}
+    for resource_type, future in futures.items():
+        try:
+            inventory[resource_type] = future.result()
+        except Exception as e:
+            app.logger.error(f"Error listing {resource_type} inventory: {str(e)}")
+            issues.append(f"Error listing {resource_type} inventory: {str(e)}")
+    return inventory
+
+def get_attached_vm_id(resource_type, resource, nic_vm_ids):
+    if resource_type == 'network_interface':
+        return resource.virtual_machine.id.lower() if resource.virtual_machine else None
+    if resource_type == 'public_ip_address' and resource.ip_configuration:
+        return nic_vm_ids.get('/'.join(resource.ip_configuration.id.lower().split('/')[:9]))
+    if resource_type == 'disk':
+        return resource.managed_by.lower() if resource.managed_by else None
+    return None
+
+def cache_inventory(subscription_id, inventory, now):
+    # Replaces the subscription's snapshot of each listed type
+    nic_vm_ids = {
+        nic.id.lower(): nic.virtual_machine.id.lower()
+        for nic in inventory.get('network_interface', [])
+        if nic.virtual_machine
+    }
+    rows = []
+    for resource_type, resources in inventory.items():
+        serialize = INVENTORY_TYPES[resource_type][1]
+        for resource in resources:
+            rows.append({
+                'id': resource.id,
+                'subscription_id': subscription_id,
+                'resource_type': resource_type,
+                'name': resource.name,
+                'resource_group': resource.id.split('/')[4],
+                'location': resource.location,
+                'vm_id': get_attached_vm_id(resource_type, resource, nic_vm_ids),
+                'data': json.dumps(serialize(resource)),
+                'last_updated': now
+            })
+    upsert_rows(InventoryCache, rows)
+    if inventory:
+        InventoryCache.query.filter(
+            InventoryCache.subscription_id == subscription_id,
+            InventoryCache.resource_type.in_(list(inventory)),
+            InventoryCache.last_updated < now
+        ).delete(synchronize_session=False)
+
+def classify_power_state(status):
+    # Statuses are display strings such as 'VM running' or 'VM deallocated'
+    state = (status or '').lower()
+    if state.startswith('vm '):
+        state = state[3:]
+    if state == 'running':
+        return 'running'
+    if state in ('stopped', 'deallocated'):
+        return 'stopped'
+    return 'other'
+
+def compute_kpi_aggregates(subscription_ids):
+    # GROUP BY over the cached rows; returns {subscription_id: {dimension: {key: count}}}
+    aggregates = {subscription_id: {'power': {}, 'region': {}, 'size': {}} for subscription_id in subscription_ids}
+    for dimension, column in (('power', VMCache.status), ('region', VMCache.location), ('size', VMCache.vm_size)):
+        rows = (
+            db.session.query(VMCache.subscription_id, column, db.func.count())
+            .filter(VMCache.subscription_id.in_(subscription_ids))
+            .group_by(VMCache.subscription_id, column)
+            .all()
+        )
+        for subscription_id, value, count in rows:
+            key = classify_power_state(value) if dimension == 'power' else (value or 'unknown')
+            counts = aggregates[subscription_id][dimension]
+            counts[key] = counts.get(key, 0) + count
+    return aggregates
+
+def update_kpi_aggregates(subscription_id):
+    # Runs inside the caller's transaction so aggregates and rows change together
+    db.session.flush()
+    now = datetime.now(timezone.utc)
+    aggregates = compute_kpi_aggregates([subscription_id])[subscription_id]
+    KPIAggregate.query.filter_by(subscription_id=subscription_id).delete()
+    for dimension, counts in aggregates.items():
+        for key, count in counts.items():
+            db.session.add(KPIAggregate(
+                subscription_id=subscription_id,
+                dimension=dimension,
+                key=key,
+                count=count,
+                last_updated=now
+            ))
+    return aggregates
+
+HISTORY_RESOLUTIONS = {
+    'hour': (timedelta(hours=1), KPI_HISTORY_HOURLY_RETENTION),
+    'day': (timedelta(days=1), KPI_HISTORY_DAILY_RETENTION),
+}
+
+def get_history_bucket_start(moment, resolution):
+    bucket_seconds = HISTORY_RESOLUTIONS[resolution][0].total_seconds()
+    timestamp = moment.timestamp()
+    return datetime.fromtimestamp(timestamp - timestamp % bucket_seconds, timezone.utc)
+
+def update_kpi_history(subscription_id, now):
+    # Rewrites the subscription's current hour and day from VMCache, so each
+    # bucket holds the counts of the last sync in it, and evicts expired buckets
+    rows = (
+        db.session.query(VMCache.location, VMCache.status, VMCache.vm_size, db.func.count())
+        .filter(VMCache.subscription_id == subscription_id)
+        .group_by(VMCache.location, VMCache.status, VMCache.vm_size)
+        .all()
+    )
+    counts = {}
+    for location, status, vm_size, count in rows:
+        power = classify_power_state(status)
+        for key in (('location', location or 'unknown', power), ('vm_size', vm_size or 'unknown', power)):
+            counts[key] = counts.get(key, 0) + count
+
+    for resolution, (_, retention) in HISTORY_RESOLUTIONS.items():
+        bucket_start = get_history_bucket_start(now, resolution)
+        KPIHistory.query.filter(
+            KPIHistory.resolution == resolution,
+            KPIHistory.bucket_start == bucket_start,
+            KPIHistory.subscription_id == subscription_id
+        ).delete(synchronize_session=False)
+        KPIHistory.query.filter(
+            KPIHistory.resolution == resolution,
+            KPIHistory.bucket_start < now - retention,
+            KPIHistory.subscription_id == subscription_id
+        ).delete(synchronize_session=False)
+        if counts:
+            db.session.execute(db.insert(KPIHistory), [{
+                'resolution': resolution,
+                'dimension': dimension,
+                'bucket_start': bucket_start,
+                'subscription_id': subscription_id,
+                'key': key,
+                'power': power,
+                'count': count
+            } for (dimension, key, power), count in counts.items()])
+
+def get_vm_states(subscription_id):
+    # Tracked fields per lowercased VM ID, read before a sync overwrites them
+    return {
+        vm_id.lower(): (status, vm_size, location)
+        for vm_id, status, vm_size, location in db.session.query(
+            VMCache.id, VMCache.status, VMCache.vm_size, VMCache.location
+        ).filter_by(subscription_id=subscription_id)
+    }
+
+def record_vm_changes(subscription_id, previous_states, vms, removed_ids, now):
+    # Only VMs whose tracked fields differ from previous_states are logged
+    rows = []
+    for vm_data in vms:
+        vm_id = vm_data['id'].lower()
+        state = (vm_data['status'], vm_data['vm_size'], vm_data['location'])
+        previous = previous_states.get(vm_id)
+        if previous == state:
+            continue
+        rows.append((vm_id, 'created' if previous is None else 'updated', state))
+    rows.extend((vm_id, 'deleted', previous_states[vm_id]) for vm_id in removed_ids)
+
+    if rows:
+        db.session.execute(db.insert(VMStateChange), [{
+            'vm_id': vm_id,
+            'subscription_id': subscription_id,
+            'changed_at': now,
+            'change_type': change_type,
+            'status': status,
+            'vm_size': vm_size,
+            'location': location
+        } for vm_id, change_type, (status, vm_size, location) in rows])
+    VMStateChange.query.filter(
+        VMStateChange.subscription_id == subscription_id,
+        VMStateChange.changed_at < now - VM_HISTORY_RETENTION
+    ).delete(synchronize_session=False)
+
+def load_kpi_aggregates(subscription_ids):
+    aggregates = {}
+    for row in KPIAggregate.query.filter(KPIAggregate.subscription_id.in_(subscription_ids)).all():
+        counts = aggregates.setdefault(row.subscription_id, {'power': {}, 'region': {}, 'size': {}})
+        counts[row.dimension][row.key] = row.count
+
+    # Rows cached before aggregates were materialized fall back to a GROUP BY
+    missing = [subscription_id for subscription_id in subscription_ids if subscription_id not in aggregates]
+    if missing:
+        aggregates.update({
+            subscription_id: counts
+            for subscription_id, counts in compute_kpi_aggregates(missing).items()
+            if any(counts['power'].values())
+        })
+    return aggregates
+
+def crawl_subscription_vms(compute_client, network_client, subscription_id, issues):
+    # Reads that fail without failing the crawl are appended to issues.
+    # The subscription-wide listings are independent, so run them side by side;
+    # the NIC and public IP listings serve both the VM rows and the inventory
+    power_states_future = list_executor.submit(get_power_states, compute_client)
+    network_future = list_executor.submit(get_network_index, network_client)
+    inventory_futures = submit_inventory_listings(
+        get_inventory_listings(compute_client, network_client, subscription_id),
+        ('virtual_network', 'network_security_group', 'disk', 'storage_account')
+    )
+    vm_list = call_arm('virtual_machines.list_all', lambda: list(compute_client.virtual_machines.list_all()))
+    power_states = power_states_future.result()
+    inventory = collect_inventory(inventory_futures, issues)
+    try:
+        nics, public_ips = network_future.result()
+        inventory['network_interface'] = list(nics.values())
+        inventory['public_ip_address'] = list(public_ips.values())
+    except Exception as e:
+        app.logger.error(f"Error fetching network info: {str(e)}")
+        issues.append(f"Error fetching network info: {str(e)}")
+        nics, public_ips = {}, {}
+
+    now = datetime.now(timezone.utc)
+    vms = []
+    failed_ids = []
+    for vm in vm_list:
+        try:
+            vms.append(build_vm_data(vm, subscription_id, power_states, nics, public_ips))
+            app.logger.debug(f"Processed VM: {vm.name}")
+        except Exception as e:
+            app.logger.error(f"Error processing VM {vm.name}: {str(e)}")
+            issues.append(f"Error processing VM {vm.name}: {str(e)}")
+            failed_ids.append(vm.id)
+            continue
+
+    previous_states = get_vm_states(subscription_id)
+    # Previous rows are only read back when a page is listening for VM changes
+    previous = None
+    if change_broker.has_listeners(subscription_id, 'vms'):
+        previous = {
+            vm_id.lower(): data
+            for vm_id, data in db.session.query(VMCache.id, VMCache.data).filter_by(subscription_id=subscription_id)
+        }
+
+    # The subscription's snapshot is replaced in a single transaction: rows are
+    # upserted, rows not seen by this crawl removed and the aggregates rebuilt,
+    # so readers see either the previous crawl or this one
+    with DB_WRITE_DURATION.labels('full_crawl').time():
+        cache_vms(vms, now)
+        removed = VMCache.query.filter(
+            VMCache.subscription_id == subscription_id,
+            VMCache.last_updated < now,
+            VMCache.id.notin_(failed_ids)
+        ).delete(synchronize_session=False)
+        cache_inventory(subscription_id, inventory, now)
+        seen_ids = {vm_id.lower() for vm_id in [vm_data['id'] for vm_data in vms] + failed_ids}
+        removed_ids = [vm_id for vm_id in previous_states if vm_id not in seen_ids]
+        record_vm_changes(subscription_id, previous_states, vms, removed_ids, now)
+        aggregates = update_kpi_aggregates(subscription_id)
+        update_kpi_history(subscription_id, now)
         db.session.commit()
+    bump_query_cache([subscription_id])
+    if removed:
+        app.logger.info(f"Removed {removed} VMs no longer in subscription {subscription_id}")
+    publish_vm_changes(subscription_id, previous, vms, removed_ids, aggregates)
+    return vms
+
+def fetch_and_cache_vms(compute_client, subscription_id, network_client=None):
+    vms = []
+    try:
+        if network_client is None:
+            network_client = get_network_client(subscription_id)
+        vms = crawl_subscription_vms(compute_client, network_client, subscription_id, [])
     except Exception as e:
         app.logger.error(f"Error fetching VMs from Azure: {str(e)}")
         db.session.rollback()
         
     return vms
 
+CHANGE_TRACKED_TYPES = ['microsoft.compute/virtualmachines'] + [resource_type for resource_type, _ in INVENTORY_TYPES.values()]
+
+def query_resource_changes(subscription_id, since):
+    # Resource Graph change tracking for the resource types VM rows and the
+    # inventory are built from
+    resource_types = ', '.join(f"'{resource_type}'" for resource_type in CHANGE_TRACKED_TYPES)
+    query = f"""resourcechanges
+| where subscriptionId == '{subscription_id}'
+| extend changeTime = todatetime(properties.changeAttributes.timestamp),
+         targetResourceId = tolower(tostring(properties.targetResourceId)),
+         targetResourceType = tolower(tostring(properties.targetResourceType)),
+         changeType = tostring(properties.changeType)
+| where changeTime > datetime({since.isoformat()})
+| where targetResourceType in ({resource_types})
+| project targetResourceId, targetResourceType, changeType, changeTime"""
+    graph_client = get_resource_graph_client()
+    changes = []
+    skip_token = None
+    while True:
+        response = call_arm('resource_graph.resources', graph_client.resources, azure_class('QueryRequest')(
+            subscriptions=[subscription_id],
+            query=query,
+            options=azure_class('QueryRequestOptions')(skip_token=skip_token, result_format='objectArray')
+        ))
+        changes.extend(response.data)
+        skip_token = response.skip_token
+        if not skip_token:
+            return changes
+
+def parse_resource_id(resource_id):
+    parts = resource_id.split('/')
+    return parts[4], parts[8]
+
+def resolve_changed_vm_ids(network_client, changes, issues):
+    # Maps changed NICs and public IPs back to the VMs they are attached to.
+    # Deleted NICs and public IPs show up as an update of their VM or NIC as well.
+    vm_ids = set()
+    nic_ids = set()
+    for change in changes:
+        resource_id = change['targetResourceId']
+        resource_type = change['targetResourceType']
+        if resource_type == 'microsoft.compute/virtualmachines':
+            vm_ids.add(resource_id)
+        elif change['changeType'] == 'Delete':
+            continue
+        elif resource_type == 'microsoft.network/networkinterfaces':
+            nic_ids.add(resource_id)
+        elif resource_type == 'microsoft.network/publicipaddresses':
+            try:
+                public_ip = call_arm('public_ip_addresses.get', network_client.public_ip_addresses.get, *parse_resource_id(resource_id))
+            except Exception as e:
+                app.logger.warning(f"Error resolving public IP {resource_id}: {str(e)}")
+                issues.append(f"Error resolving public IP {resource_id}: {str(e)}")
+                continue
+            if public_ip.ip_configuration:
+                nic_ids.add('/'.join(public_ip.ip_configuration.id.lower().split('/')[:9]))
+
+    for nic_id in nic_ids:
+        try:
+            nic = call_arm('network_interfaces.get', network_client.network_interfaces.get, *parse_resource_id(nic_id))
+        except Exception as e:
+            app.logger.warning(f"Error resolving network interface {nic_id}: {str(e)}")
+            issues.append(f"Error resolving network interface {nic_id}: {str(e)}")
+            continue
+        if nic.virtual_machine:
+            vm_ids.add(nic.virtual_machine.id.lower())
+    return vm_ids
+
+def get_vm_network(network_client, vm, issues):
+    # Point reads of one VM's NICs and public IPs, for the few VMs a delta sync touches
+    nics = {}
+    public_ips = {}
+    for nic_ref in vm.network_profile.network_interfaces if vm.network_profile else []:
+        try:
+            nic = call_arm('network_interfaces.get', network_client.network_interfaces.get, *parse_resource_id(nic_ref.id))
+        except Exception as e:
+            app.logger.error(f"Error fetching network info: {str(e)}")
+            issues.append(f"Error fetching network interface {nic_ref.id}: {str(e)}")
+            continue
+        nics[nic.id.lower()] = nic
+        for ip_config in nic.ip_configurations or []:
+            if ip_config.public_ip_address and not ip_config.public_ip_address.ip_address:
+                public_ip = call_arm('public_ip_addresses.get', network_client.public_ip_addresses.get, *parse_resource_id(ip_config.public_ip_address.id))
+                public_ips[public_ip.id.lower()] = public_ip
+    return nics, public_ips
+
+def delta_sync_vms(compute_client, network_client, subscription_id, changes, issues):
+    # Applies the Resource Graph changes since the last sync; reads that fail
+    # without failing the sync are appended to issues
+    # Power state changes are not tracked by Resource Graph, so statuses are
+    # always re-read in bulk; the listing also reveals creates and deletes
+    power_states = get_power_states(compute_client)
+    cached = {
+        cached_vm.id.lower(): cached_vm
+        for cached_vm in VMCache.query.filter_by(subscription_id=subscription_id).all()
+    }
+
+    changed_ids = resolve_changed_vm_ids(network_client, changes, issues) | (set(power_states) - set(cached))
+    deleted_ids = set(cached) - set(power_states)
+    updates = []
+
+    # Inventory groups with a changed resource are re-listed in bulk; all of
+    # them when the subscription has no inventory cached yet
+    changed_types = {change['targetResourceType'] for change in changes}
+    has_inventory = InventoryCache.query.filter_by(subscription_id=subscription_id).first() is not None
+    inventory_types = [
+        resource_type
+        for group in INVENTORY_GROUPS.values()
+        if not has_inventory or changed_types & {INVENTORY_TYPES[resource_type][0] for resource_type in group}
+        for resource_type in group
+    ]
+    inventory_futures = {}
+    if inventory_types:
+        listings = get_inventory_listings(compute_client, network_client, subscription_id)
+        inventory_futures = submit_inventory_listings(listings, inventory_types)
+
+    for vm_id in changed_ids - deleted_ids:
+        if vm_id not in power_states:
+            continue
+        try:
+            vm = call_arm('virtual_machines.get', compute_client.virtual_machines.get, *parse_resource_id(vm_id))
+            nics, public_ips = get_vm_network(network_client, vm, issues)
+            updates.append(build_vm_data(vm, subscription_id, power_states, nics, public_ips))
+        except Exception as e:
+            app.logger.error(f"Error processing VM {vm_id}: {str(e)}")
+            issues.append(f"Error processing VM {vm_id}: {str(e)}")
+            continue
+
+    for vm_id, cached_vm in cached.items():
+        if vm_id in changed_ids or vm_id in deleted_ids or cached_vm.status == power_states[vm_id]:
+            continue
+        try:
+            vm_data = json.loads(cached_vm.data)
+        except json.JSONDecodeError as e:
+            app.logger.error(f"Error decoding cached VM data: {str(e)}")
+            continue
+        vm_data['status'] = power_states[vm_id]
+        updates.append(vm_data)
+
+    inventory = collect_inventory(inventory_futures, issues)
+    # Read before the commit expires the cached rows
+    previous_states = {
+        vm_id: (cached_vm.status, cached_vm.vm_size, cached_vm.location)
+        for vm_id, cached_vm in cached.items()
+    }
+    previous = None
+    if change_broker.has_listeners(subscription_id, 'vms'):
+        previous = {vm_id: cached_vm.data for vm_id, cached_vm in cached.items()}
+    with DB_WRITE_DURATION.labels('delta_sync').time():
+        now = datetime.now(timezone.utc)
+        cache_vms(updates, now)
+        cache_inventory(subscription_id, inventory, now)
+        # Tombstone VMs that no longer exist in Azure
+        if deleted_ids:
+            VMCache.query.filter(
+                VMCache.id.in_([cached[vm_id].id for vm_id in deleted_ids])
+            ).delete(synchronize_session=False)
+
+        record_vm_changes(subscription_id, previous_states, updates, list(deleted_ids), now)
+        aggregates = update_kpi_aggregates(subscription_id)
+        update_kpi_history(subscription_id, now)
+        db.session.commit()
+    bump_query_cache([subscription_id])
+    publish_vm_changes(subscription_id, previous, updates, list(deleted_ids), aggregates)
+    app.logger.info(f"Delta sync for subscription {subscription_id}: {len(changes)} changes, {len(updates)} VMs written, {len(deleted_ids)} removed")
+    return len(updates), len(deleted_ids)
+
+def sync_subscription_vms(subscription_id, full=False):
+    # Full crawl on first sync, on request and every FULL_SYNC_INTERVAL;
+    # incremental Resource Graph driven sync otherwise
+    started = datetime.now(timezone.utc)
+    state = db.session.get(VMSyncState, subscription_id) or VMSyncState(subscription_id=subscription_id)
+    full = (
+        full or not DELTA_SYNC_ENABLED
+        or state.last_synced is None or state.last_full_sync is None
+        or is_cache_expired(state.last_full_sync, FULL_SYNC_INTERVAL)
+    )
+
+    sync_started = time.perf_counter()
+    changes = None
+    if not full:
+        # Without Resource Graph change tracking (no access, provider not
+        # registered, a cloud without it) this pass crawls instead, so the
+        # cache doesn't stay stale until the next scheduled full crawl
+        try:
+            changes = query_resource_changes(subscription_id, as_utc(state.last_synced) - DELTA_SYNC_OVERLAP)
+        except Exception as e:
+            app.logger.warning(f"Resource change query failed for subscription {subscription_id}, running a full crawl: {str(e)}")
+            SYNC_FALLBACKS.labels(subscription_id).inc()
+            full = True
+
+    mode = 'full' if full else 'delta'
+    compute_client = get_compute_client(subscription_id)
+    network_client = get_network_client(subscription_id)
+    issues = []
+    try:
+        if full:
+            crawl_subscription_vms(compute_client, network_client, subscription_id, issues)
+            state.last_full_sync = started
+        else:
+            delta_sync_vms(compute_client, network_client, subscription_id, changes, issues)
+        state.last_synced = started
+        state.error_count = len(issues)
+        state.errors = json.dumps(issues[:SYNC_ERROR_LIMIT]) if issues else None
+        db.session.merge(state)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        SYNC_FAILURES.labels(subscription_id, mode).inc()
+        raise
+    finally:
+        SYNC_DURATION.labels(subscription_id, mode).observe(time.perf_counter() - sync_started)
+    if issues:
+        app.logger.warning(f"Partial {mode} sync of subscription {subscription_id}: {len(issues)} reads failed")
+    return issues
+
+def get_last_synced(subscription_ids):
+    return {
+        state.subscription_id: as_utc(state.last_synced)
+        for state in VMSyncState.query.filter(VMSyncState.subscription_id.in_(subscription_ids)).all()
+        if state.last_synced is not None
+    }
+
+# Re-crawls subscriptions in the background so API requests can always be
+# served from VMCache. Refreshes are single-flighted per subscription: a job
+# for a subscription that is already being crawled attaches to that crawl.
+class RefreshScheduler:
+    def __init__(self, interval):
+        self.interval = interval
+        self._inflight = {}
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self, subscription_ids, full=False):
+        with self._lock:
+            futures = {}
+            for subscription_id in subscription_ids:
+                future = self._inflight.get(subscription_id)
+                if future is None or future.done():
+                    future = subscription_executor.submit(run_with_app_context, sync_subscription_vms, subscription_id, full)
+                    self._inflight[subscription_id] = future
+                futures[subscription_id] = future
+
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                'subscription_ids': list(subscription_ids),
+                'created_at': datetime.now(timezone.utc),
+                'futures': futures
+            }
+            while len(self._jobs) > REFRESH_JOB_HISTORY:
+                self._jobs.popitem(last=False)
+        return job_id
+
+    def get_job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+
+        # A subscription is 'partial' when its sync completed but skipped reads
+        # (throttled or failed), listed in errors
+        subscriptions = {}
+        errors = {}
+        for subscription_id, future in job['futures'].items():
+            if not future.done():
+                subscriptions[subscription_id] = 'running'
+            elif future.exception() is not None:
+                subscriptions[subscription_id] = 'failed'
+                errors[subscription_id] = [str(future.exception())]
+            elif future.result():
+                subscriptions[subscription_id] = 'partial'
+                errors[subscription_id] = future.result()[:SYNC_ERROR_LIMIT]
+            else:
+                subscriptions[subscription_id] = 'completed'
+
+        status = next(
+            (status for status in ('running', 'failed', 'partial') if status in subscriptions.values()),
+            'completed'
+        )
+        return {
+            'id': job_id,
+            'status': status,
+            'created_at': job['created_at'].isoformat(),
+            'subscriptions': subscriptions,
+            'errors': errors
+        }
+
+    def refresh_due(self):
+        # Subscriptions are still listed from the cache while the credential is
+        # missing, but crawling them would only fail
+        if not get_azure_credential():
+            return None
+        subscription_ids = [sub['id'] for sub in get_subscriptions()]
+        if not subscription_ids:
+            return None
+
+        last_synced = get_last_synced(subscription_ids)
+        due = []
+        for subscription_id in subscription_ids:
+            refreshed = last_synced.get(subscription_id)
+            if refreshed is None or is_cache_expired(refreshed, self.interval):
+                due.append(subscription_id)
+
+        if not due:
+            return None
+        app.logger.info(f"Scheduling background refresh for {len(due)} subscriptions")
+        return self.refresh(due)
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                with app.app_context():
+                    self.refresh_due()
+            except Exception as e:
+                app.logger.error(f"Error scheduling background refresh: {str(e)}")
+            self._stop.wait(min(30, self.interval.total_seconds()))
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name='vm-refresh-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+refresh_scheduler = RefreshScheduler(VM_REFRESH_INTERVAL)
+
+@app.cli.command('refresh-worker')
+def refresh_worker():
+    # Runs the refresher in its own process, for deployments that set
+    # BACKGROUND_REFRESH_ENABLED=false on the web workers
+    refresh_scheduler.run()
+
 @app.route('/')
 def index():
     try:
@@ -212,212 +1615,622 @@ def serve_static(path):
 
 @app.route('/api/subscriptions')
 def list_subscriptions():
-    return jsonify(get_subscriptions())
+    force_refresh = request.args.get('force_refresh', 'false').lower() == 'true'
+    response = jsonify(get_subscriptions(force_refresh))
+    response.add_etag(weak=True)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/api/check-login')
 def check_login():
     try:
-        # Try to get subscriptions as a login test
-        subscriptions = get_subscriptions()
-        if subscriptions:
+        # A valid (cached) management token is enough to count as logged in
+        if get_azure_credential():
             return jsonify({'status': 'logged_in'})
         else:
-            return jsonify({'status': 'not_logged_in', 'message': 'No subscriptions found. Please login to Azure.'}), 401
+            return jsonify({'status': 'not_logged_in', 'message': 'No valid Azure credential found. Please login to Azure.'}), 401
     except Exception as e:
         app.logger.error(f"Error checking login: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+# Columns /api/vms can sort by; ties are broken by VM id so cursors are stable
+VM_SORT_COLUMNS = {
+    'name': VMCache.name,
+    'resource_group': VMCache.resource_group,
+    'location': VMCache.location,
+    'vm_size': VMCache.vm_size,
+    'status': VMCache.status,
+    'os_type': VMCache.os_type,
+}
+
+def encode_cursor(sort_value, vm_id):
+    return base64.urlsafe_b64encode(json.dumps([sort_value, vm_id]).encode()).decode()
+
+def decode_cursor(cursor):
+    sort_value, vm_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return sort_value, vm_id
+
+def get_subscription_ids():
+    # Selected subscriptions from the request, or every subscription we can see.
+    # IDs we can't see are dropped, so request input never reaches the
+    # refresher, the client pool or the metric labels.
+    known_ids = [sub['id'] for sub in get_subscriptions()]
+    subscription_ids = [subscription_id.strip() for subscription_id in request.args.get('subscription_ids', '').split(',')]
+    subscription_ids = list(dict.fromkeys(subscription_id for subscription_id in subscription_ids if subscription_id))
+    if not subscription_ids:
+        app.logger.info("No subscriptions selected, getting all subscriptions")
+        return known_ids
+
+    unknown_ids = set(subscription_ids) - set(known_ids)
+    if unknown_ids:
+        app.logger.warning(f"Ignoring {len(unknown_ids)} unknown subscription IDs")
+    return [subscription_id for subscription_id in subscription_ids if subscription_id not in unknown_ids]
+
+def get_cache_as_of(subscription_ids):
+    # Oldest row per subscription, for subscriptions cached before sync state was tracked
+    return {
+        subscription_id: as_utc(last_updated)
+        for subscription_id, last_updated in db.session.query(VMCache.subscription_id, db.func.min(VMCache.last_updated))
+        .filter(VMCache.subscription_id.in_(subscription_ids))
+        .group_by(VMCache.subscription_id)
+        .all()
+    }
+
+def check_refresh_credential():
+    # Cache-backed endpoints are still served without a credential, flagged
+    # with X-Azure-Credential: unavailable; only their refreshes are skipped,
+    # as they would fail
+    if get_azure_credential():
+        return True
+    app.logger.error("No valid Azure credential found, serving cached data without refreshing")
+    g.credential_unavailable = True
+    return False
+
+def check_cache_freshness(subscription_ids):
+    # Returns the subscriptions whose cache is missing or expired, the time of
+    # the oldest data being served and the subscriptions whose last sync was
+    # partial. Delta syncs only rewrite changed rows, so freshness comes from
+    # the sync state.
+    states = VMSyncState.query.filter(VMSyncState.subscription_id.in_(subscription_ids)).all()
+    subscriptions_as_of = {state.subscription_id: as_utc(state.last_synced) for state in states if state.last_synced is not None}
+    partial_ids = [state.subscription_id for state in states if state.error_count]
+    unsynced_ids = [subscription_id for subscription_id in subscription_ids if subscription_id not in subscriptions_as_of]
+    if unsynced_ids:
+        subscriptions_as_of.update(get_cache_as_of(unsynced_ids))
+
+    stale_ids = []
+    as_of = None
+    for subscription_id in subscription_ids:
+        last_updated = subscriptions_as_of.get(subscription_id)
+        if last_updated is None:
+            VM_CACHE_LOOKUPS.labels('miss').inc()
+            stale_ids.append(subscription_id)
+        elif is_cache_expired(last_updated, VM_CACHE_DURATION):
+            VM_CACHE_LOOKUPS.labels('expired').inc()
+            stale_ids.append(subscription_id)
+        else:
+            VM_CACHE_LOOKUPS.labels('hit').inc()
+        if last_updated is not None and (as_of is None or last_updated < as_of):
+            as_of = last_updated
+    return stale_ids, as_of, partial_ids
+
+def get_content_version(subscription_ids, model=VMCache):
+    # Row count and newest write across the subscriptions; any upsert moves
+    # the timestamp and any delete changes the count
+    count, last_updated = (
+        db.session.query(db.func.count(model.id), db.func.max(model.last_updated))
+        .filter(model.subscription_id.in_(subscription_ids))
+        .one()
+    )
+    return count, as_utc(last_updated) if last_updated else None
+
+def check_conditional(subscription_ids, model=VMCache, stream=False):
+    # Returns (etag, last_modified, not_modified) for a cached-data query; the
+    # ETag covers the endpoint, its query parameters, the representation (JSON
+    # or NDJSON, which /api/vms picks from Accept) and the content version, so
+    # it can be checked before the body is built
+    count, last_updated = get_content_version(subscription_ids, model)
+    version = [request.path, sorted(request.args.items(multi=True)), stream, subscription_ids, count, last_updated]
+    etag = hashlib.sha1(json.dumps(version, default=str).encode()).hexdigest()
+    # A sync that only deletes rows leaves the newest write where it was, so
+    # Last-Modified also follows the subscriptions' last completed sync
+    last_modified = max(filter(None, [last_updated, *get_last_synced(subscription_ids).values()]), default=None)
+    return etag, last_modified, is_not_modified(etag, last_modified)
+
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    return bool(
+        last_modified and request.if_modified_since
+        and last_modified.replace(microsecond=0) <= request.if_modified_since
+    )
+
+def set_conditional_headers(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    # Let browsers keep the body but revalidate it on every poll
+    response.cache_control.no_cache = True
+    return response
+
+def not_modified_response(etag, last_modified):
+    return set_conditional_headers(app.response_class(status=304), etag, last_modified)
+
+def set_cache_headers(response, stale_ids, as_of, job_id=None, partial_ids=None):
+    response.headers['X-Cache-Stale'] = 'true' if stale_ids else 'false'
+    response.headers['X-Cache-As-Of'] = as_of.isoformat() if as_of else ''
+    if job_id:
+        response.headers['X-Refresh-Job-Id'] = job_id
+    # Subscriptions whose last sync skipped reads, so some of their rows are older than X-Cache-As-Of
+    if partial_ids:
+        response.headers['X-Partial-Subscriptions'] = ','.join(partial_ids)
+    return response
+
+# Rendered /api/vms responses keyed by path, query parameters, subscription set
+# and Accept-Encoding, so hot dashboard queries skip SQL, JSON encoding and
+# compression. Every key embeds the version of each subscription's snapshot,
+# bumped whenever a sync rewrites it, so a rewrite orphans the old entries
+# instead of having to find them; the LRU evicts them eventually.
+class MemoryQueryStore:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get_versions(self, subscription_ids):
+        with self._lock:
+            return [self._versions.get(subscription_id, 0) for subscription_id in subscription_ids]
+
+    def bump(self, subscription_ids):
+        with self._lock:
+            for subscription_id in subscription_ids:
+                self._versions[subscription_id] = self._versions.get(subscription_id, 0) + 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        size = len(entry['body'])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous['body'])
+            self._entries[key] = entry
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted['body'])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+# Same interface backed by Redis; eviction is left to the server's maxmemory
+# policy, and entries expire once the data they hold would be stale anyway
+class RedisQueryStore:
+    def __init__(self, url, ttl):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get_versions(self, subscription_ids):
+        values = self.client.mget([f"azboard:version:{subscription_id}" for subscription_id in subscription_ids])
+        return [int(value or 0) for value in values]
+
+    def bump(self, subscription_ids):
+        pipeline = self.client.pipeline()
+        for subscription_id in subscription_ids:
+            pipeline.incr(f"azboard:version:{subscription_id}")
+        pipeline.execute()
+
+    def get(self, key):
+        value = self.client.get(f"azboard:query:{key}")
+        if value is None:
+            return None
+        headers, _, body = value.partition(b'\n')
+        return {'headers': json.loads(headers), 'body': body}
+
+    def set(self, key, entry):
+        value = json.dumps(entry['headers']).encode() + b'\n' + entry['body']
+        self.client.set(f"azboard:query:{key}", value, ex=self.ttl)
+
+    def clear(self):
+        keys = list(self.client.scan_iter('azboard:query:*'))
+        if keys:
+            self.client.delete(*keys)
+
+if not QUERY_CACHE_ENABLED:
+    query_cache = None
+elif QUERY_CACHE_REDIS_URL:
+    query_cache = RedisQueryStore(QUERY_CACHE_REDIS_URL, int(VM_CACHE_DURATION.total_seconds()))
+else:
+    query_cache = MemoryQueryStore(QUERY_CACHE_MAX_BYTES)
+
+# Response headers replayed on a query cache hit
+QUERY_CACHE_HEADERS = ('Content-Type', 'Content-Encoding', 'Vary', 'ETag', 'Last-Modified', 'Cache-Control',
+                       'X-Cache-Stale', 'X-Cache-As-Of', 'X-Partial-Subscriptions', 'X-Next-Cursor')
+
+def bump_query_cache(subscription_ids):
+    if query_cache is None:
+        return
+    try:
+        query_cache.bump(subscription_ids)
+    except Exception as e:
+        app.logger.error(f"Error invalidating query cache: {str(e)}")
+
+def get_query_cache_key(subscription_ids):
+    versions = query_cache.get_versions(subscription_ids)
+    key = [request.path, sorted(request.args.items(multi=True)), subscription_ids, versions,
+           request.headers.get('Accept-Encoding', '')]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+def get_cached_query_response(cache_key):
+    entry = query_cache.get(cache_key)
+    as_of = datetime.fromisoformat(entry['headers']['X-Cache-As-Of']) if entry is not None else None
+    # Entries outlive VM_CACHE_DURATION in memory; past it the regular path
+    # serves the request and schedules the refresh
+    if entry is None or is_cache_expired(as_of, VM_CACHE_DURATION):
+        QUERY_CACHE_LOOKUPS.labels('miss').inc()
+        return None
+    QUERY_CACHE_LOOKUPS.labels('hit').inc()
+
+    response = app.response_class(entry['body'], headers=entry['headers'])
+    etag, _ = response.get_etag()
+    if is_not_modified(etag, response.last_modified):
+        return set_cache_headers(not_modified_response(etag, response.last_modified), [], as_of)
+    return response
+
+def store_query_response(cache_key, response):
+    try:
+        query_cache.set(cache_key, {
+            'headers': {header: response.headers[header] for header in QUERY_CACHE_HEADERS if header in response.headers},
+            'body': response.get_data()
+        })
+    except Exception as e:
+        app.logger.error(f"Error storing query cache entry: {str(e)}")
+
+# VM columns an /api/events listener can filter on, compared case-insensitively like /api/vms
+EVENT_FILTERS = ('resource_group', 'location', 'status', 'vm_size')
+# Events an /api/events listener can pick with types; a published 'reset' is
+# about VM changes and goes with 'vms'
+EVENT_TYPES = ('vms', 'kpi')
+
+class ChangeListener:
+    def __init__(self, subscription_ids, filters, types, queue_size):
+        self.subscription_ids = set(subscription_ids)
+        self.filters = filters
+        self.types = set(types)
+        self.queue = queue.Queue(queue_size)
+        self.overflowed = False
+
+# Fans out committed changes to the open /api/events streams. Each sync
+# publishes once per subscription however many pages are listening; with
+# EVENT_STREAM_REDIS_URL set, events go through Redis so streams served by
+# other processes receive them too.
+class ChangeBroker:
+    def __init__(self, queue_size, max_listeners, redis_url=None):
+        self.queue_size = queue_size
+        self.max_listeners = max_listeners
+        self._listeners = set()
+        self._lock = threading.Lock()
+        self._redis = None
+        self._relay = None
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(redis_url)
+
+    def listen(self, subscription_ids, filters, types=EVENT_TYPES):
+        # Returns None when max_listeners streams are already open
+        listener = ChangeListener(subscription_ids, filters, types, self.queue_size)
+        with self._lock:
+            if len(self._listeners) >= self.max_listeners:
+                return None
+            self._listeners.add(listener)
+            if self._redis is not None and (self._relay is None or not self._relay.is_alive()):
+                self._relay = threading.Thread(target=self._run_relay, name='event-relay', daemon=True)
+                self._relay.start()
+        EVENT_STREAM_LISTENERS.inc()
+        return listener
+
+    def close(self, listener):
+        with self._lock:
+            self._listeners.discard(listener)
+        EVENT_STREAM_LISTENERS.dec()
+
+    def has_listeners(self, subscription_id, event_type=None):
+        # Listeners in other processes can't be seen, so assume there are some
+        if self._redis is not None:
+            return True
+        with self._lock:
+            return any(
+                subscription_id in listener.subscription_ids and (event_type is None or event_type in listener.types)
+                for listener in self._listeners
+            )
+
+    def publish(self, subscription_id, name, data):
+        EVENTS_PUBLISHED.labels(name).inc()
+        if self._redis is not None:
+            self._redis.publish('azboard:events', json.dumps([subscription_id, name, data]))
+        else:
+            self._dispatch(subscription_id, name, data)
+
+    def _dispatch(self, subscription_id, name, data):
+        with self._lock:
+            listeners = [listener for listener in self._listeners if subscription_id in listener.subscription_ids]
+        for listener in listeners:
+            if ('vms' if name == 'reset' else name) not in listener.types:
+                continue
+            event = data
+            if name == 'vms' and listener.filters:
+                event = filter_vm_changes(data, listener.filters)
+                if not event['upserted'] and not event['removed']:
+                    continue
+            try:
+                listener.queue.put_nowait((name, event))
+            except queue.Full:
+                # Too far behind to catch up event by event; the stream resets it
+                listener.overflowed = True
+
+    def _run_relay(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe('azboard:events')
+                for message in pubsub.listen():
+                    self._dispatch(*json.loads(message['data']))
+            except Exception as e:
+                app.logger.error(f"Error relaying events from Redis: {str(e)}")
+                time.sleep(1)
+
+change_broker = ChangeBroker(EVENT_STREAM_QUEUE_SIZE, EVENT_STREAM_MAX_LISTENERS, EVENT_STREAM_REDIS_URL)
+
+def filter_vm_changes(changes, filters):
+    # VMs that changed so they no longer match the listener's filters are sent as removed
+    upserted = []
+    removed = list(changes['removed'])
+    for vm_data in changes['upserted']:
+        if all((vm_data.get(column) or '').lower() == value for column, value in filters.items()):
+            upserted.append(vm_data)
+        else:
+            removed.append(vm_data['id'].lower())
+    return {'subscription_id': changes['subscription_id'], 'upserted': upserted, 'removed': removed}
+
+def publish_vm_changes(subscription_id, previous, vms, removed_ids, aggregates):
+    # previous maps lowercased VM IDs to their cached data before the sync;
+    # only VMs whose data actually changed are sent. It is None when nobody was
+    # listening as the sync started; anyone who has connected since is reset.
+    try:
+        if previous is None:
+            if change_broker.has_listeners(subscription_id):
+                change_broker.publish(subscription_id, 'reset', {'subscription_id': subscription_id})
+                change_broker.publish(subscription_id, 'kpi', {'subscription_id': subscription_id, 'counts': aggregates})
+            return
+
+        upserted = [vm_data for vm_data in vms if previous.get(vm_data['id'].lower()) != json.dumps(vm_data)]
+        if not upserted and not removed_ids:
+            return
+        if len(upserted) + len(removed_ids) > EVENT_STREAM_MAX_CHANGES:
+            change_broker.publish(subscription_id, 'reset', {'subscription_id': subscription_id})
+        else:
+            change_broker.publish(subscription_id, 'vms', {
+                'subscription_id': subscription_id,
+                'upserted': upserted,
+                'removed': removed_ids
+            })
+        change_broker.publish(subscription_id, 'kpi', {'subscription_id': subscription_id, 'counts': aggregates})
+    except Exception as e:
+        app.logger.error(f"Error publishing changes for subscription {subscription_id}: {str(e)}")
+
+def format_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
 @app.route('/api/vms')
 def get_vms():
     try:
         app.logger.info("Fetching VMs...")
+        # JSON or NDJSON is picked from Accept, so caches must key on it
+        g.vary_accept = True
         force_refresh = request.args.get('force_refresh', 'false').lower() == 'true'
-        subscription_ids = request.args.get('subscription_ids', '').split(',')
         resource_group = request.args.get('resource_group')
+        location = request.args.get('location')
         status = request.args.get('status')
         vm_size = request.args.get('vm_size')
+        sort = request.args.get('sort', 'name')
+        descending = request.args.get('order', 'asc').lower() == 'desc'
+        limit = request.args.get('limit', type=int)
+        cursor = request.args.get('cursor')
+        stream = (
+            request.args.get('stream', 'false').lower() in ('1', 'true')
+            or 'application/x-ndjson' in request.headers.get('Accept', '')
+        )
 
-        # If no subscriptions selected, try to get all subscriptions
-        if not subscription_ids or not subscription_ids[0]:
-            app.logger.info("No subscriptions selected, getting all subscriptions")
-            subscriptions = get_subscriptions()
-            if subscriptions:
-                subscription_ids = [sub['id'] for sub in subscriptions]
-            else:
-                app.logger.warning("No subscriptions found")
-                return jsonify([])
+        if sort not in VM_SORT_COLUMNS:
+            return jsonify({'error': f"Invalid sort column: {sort}"}), 400
+        if limit is not None and limit <= 0:
+            return jsonify({'error': 'limit must be a positive integer'}), 400
+
+        subscription_ids = get_subscription_ids()
+        if not subscription_ids:
+            app.logger.warning("No subscriptions found")
+            return jsonify([])
 
         app.logger.info(f"Processing {len(subscription_ids)} subscriptions")
-        all_vms = []
-        for subscription_id in subscription_ids:
-            subscription_id = subscription_id.strip()
-            if not subscription_id:
-                continue
 
+        has_credential = check_refresh_credential()
+        if not has_credential:
+            force_refresh = False
+
+        if query_cache is not None and has_credential and not force_refresh and not stream:
             try:
-                app.logger.info(f"Processing subscription: {subscription_id}")
-                # Get VMs for this subscription
-                credential = get_azure_credential()
-                if not credential:
-                    app.logger.error("No valid Azure credential found")
-                    continue
-                    
-                compute_client = ComputeManagementClient(credential, subscription_id)
-                network_client = NetworkManagementClient(credential, subscription_id)
-                
-                # Get VMs from cache or Azure
-                if not force_refresh:
-                    cached_vms = VMCache.query.filter_by(subscription_id=subscription_id).all()
-                    if cached_vms and not is_cache_expired(cached_vms[0].last_updated, VM_CACHE_DURATION):
-                        app.logger.info(f"Using cached VMs for subscription {subscription_id}")
-                        # Each cached VM is a separate record
-                        vms_data = []
-                        for cached_vm in cached_vms:
-                            try:
-                                vm_data = json.loads(cached_vm.data)
-                                vms_data.append(vm_data)
-                            except json.JSONDecodeError as e:
-                                app.logger.error(f"Error decoding cached VM data: {str(e)}")
-                                continue
-                    else:
-                        app.logger.info(f"Cache miss or expired for subscription {subscription_id}")
-                        vms_data = []
-                        for vm in compute_client.virtual_machines.list_all():
-                            try:
-                                vm_instance = compute_client.virtual_machines.get(
-                                    vm.id.split('/')[4],
-                                    vm.name,
-                                    expand='instanceView'
-                                )
-                                
-                                # Get network interface info
-                                network_info = []
-                                for nic_ref in vm.network_profile.network_interfaces:
-                                    nic_name = nic_ref.id.split('/')[-1]
-                                    resource_group = nic_ref.id.split('/')[4]
-                                    try:
-                                        nic = network_client.network_interfaces.get(resource_group, nic_name)
-                                        for ip_config in nic.ip_configurations:
-                                            network_info.append({
-                                                'private_ip': ip_config.private_ip_address,
-                                                'public_ip': ip_config.public_ip_address.ip_address if ip_config.public_ip_address else None,
-                                                'subnet': ip_config.subnet.id.split('/')[-1] if ip_config.subnet else None
-                                            })
-                                    except Exception as e:
-                                        app.logger.error(f"Error fetching network info: {str(e)}")
-                                        network_info.append({'error': 'Failed to fetch network information'})
-
-                                vm_data = {
-                                    'id': vm.id,
-                                    'name': vm.name,
-                                    'resource_group': vm.id.split('/')[4],
-                                    'location': vm.location,
-                                    'vm_size': vm.hardware_profile.vm_size,
-                                    'os_type': vm.storage_profile.os_disk.os_type,
-                                    'status': next((status.display_status for status in vm_instance.instance_view.statuses if status.code.startswith('PowerState/')), 'unknown'),
-                                    'network_info': network_info,
-                                    'subscription_id': subscription_id
-                                }
-                                
-                                # Cache each VM separately
-                                cache_entry = VMCache(
-                                    id=vm.id,
-                                    subscription_id=subscription_id,
-                                    resource_group=vm_data['resource_group'],
-                                    data=json.dumps(vm_data),
-                                    last_updated=datetime.now(timezone.utc)
-                                )
-                                
-                                db.session.merge(cache_entry)
-                                vms_data.append(vm_data)
-                                app.logger.info(f"Processed VM: {vm.name}")
-                            except Exception as e:
-                                app.logger.error(f"Error processing VM {vm.name}: {str(e)}")
-                                continue
-                        
-                        db.session.commit()
-                else:
-                    app.logger.info(f"Force refresh requested for subscription {subscription_id}")
-                    vms_data = []
-                    for vm in compute_client.virtual_machines.list_all():
-                        try:
-                            vm_instance = compute_client.virtual_machines.get(
-                                vm.id.split('/')[4],
-                                vm.name,
-                                expand='instanceView'
-                            )
-                            
-                            # Get network interface info
-                            network_info = []
-                            for nic_ref in vm.network_profile.network_interfaces:
-                                nic_name = nic_ref.id.split('/')[-1]
-                                resource_group = nic_ref.id.split('/')[4]
-                                try:
-                                    nic = network_client.network_interfaces.get(resource_group, nic_name)
-                                    for ip_config in nic.ip_configurations:
-                                        network_info.append({
-                                            'private_ip': ip_config.private_ip_address,
-                                            'public_ip': ip_config.public_ip_address.ip_address if ip_config.public_ip_address else None,
-                                            'subnet': ip_config.subnet.id.split('/')[-1] if ip_config.subnet else None
-                                        })
-                                except Exception as e:
-                                    app.logger.error(f"Error fetching network info: {str(e)}")
-                                    network_info.append({'error': 'Failed to fetch network information'})
-
-                            vm_data = {
-                                'id': vm.id,
-                                'name': vm.name,
-                                'resource_group': vm.id.split('/')[4],
-                                'location': vm.location,
-                                'vm_size': vm.hardware_profile.vm_size,
-                                'os_type': vm.storage_profile.os_disk.os_type,
-                                'status': next((status.display_status for status in vm_instance.instance_view.statuses if status.code.startswith('PowerState/')), 'unknown'),
-                                'network_info': network_info,
-                                'subscription_id': subscription_id
-                            }
-                            
-                            # Cache each VM separately
-                            cache_entry = VMCache(
-                                id=vm.id,
-                                subscription_id=subscription_id,
-                                resource_group=vm_data['resource_group'],
-                                data=json.dumps(vm_data),
-                                last_updated=datetime.now(timezone.utc)
-                            )
-                            
-                            db.session.merge(cache_entry)
-                            vms_data.append(vm_data)
-                            app.logger.info(f"Processed VM: {vm.name}")
-                        except Exception as e:
-                            app.logger.error(f"Error processing VM {vm.name}: {str(e)}")
-                            continue
-                    
-                    db.session.commit()
-
-                # Apply filters
-                filtered_vms = []
-                for vm in vms_data:
-                    if resource_group and vm['resource_group'].lower() != resource_group.lower():
-                        continue
-                    if status and vm['status'].lower() != status.lower():
-                        continue
-                    if vm_size and vm['vm_size'].lower() != vm_size.lower():
-                        continue
-                    filtered_vms.append(vm)
-
-                all_vms.extend(filtered_vms)
-                app.logger.info(f"Found {len(filtered_vms)} VMs in subscription {subscription_id}")
+                cache_key = get_query_cache_key(subscription_ids)
+                response = get_cached_query_response(cache_key)
+                if response is not None:
+                    return response
+                # Stored by after_request once the response is final
+                g.query_cache_key = cache_key
             except Exception as e:
-                app.logger.error(f"Error processing subscription {subscription_id}: {str(e)}")
+                app.logger.error(f"Error reading query cache: {str(e)}")
+
+        # Always answer from the cache; expired or missing subscriptions are
+        # re-crawled in the background and flagged as stale in the meantime
+        stale_ids, as_of, partial_ids = check_cache_freshness(subscription_ids)
+
+        # Filtering, sorting and paging run in SQL; only the returned page is decoded
+        query = VMCache.query.filter(VMCache.subscription_id.in_(subscription_ids))
+        for column, value in ((VMCache.resource_group, resource_group), (VMCache.location, location),
+                              (VMCache.status, status), (VMCache.vm_size, vm_size)):
+            if value:
+                query = query.filter(db.func.lower(column) == value.lower())
+
+        sort_column = db.func.coalesce(VM_SORT_COLUMNS[sort], '')
+        if cursor:
+            try:
+                cursor_value, cursor_id = decode_cursor(cursor)
+            except (ValueError, TypeError):
+                return jsonify({'error': 'Invalid cursor'}), 400
+            if descending:
+                query = query.filter(db.or_(sort_column < cursor_value, db.and_(sort_column == cursor_value, VMCache.id < cursor_id)))
+            else:
+                query = query.filter(db.or_(sort_column > cursor_value, db.and_(sort_column == cursor_value, VMCache.id > cursor_id)))
+        if descending:
+            query = query.order_by(sort_column.desc(), VMCache.id.desc())
+        else:
+            query = query.order_by(sort_column, VMCache.id)
+
+        job_id = None
+        if force_refresh:
+            app.logger.info(f"Force refresh requested for {len(subscription_ids)} subscriptions")
+            job_id = refresh_scheduler.refresh(subscription_ids, full=True)
+        elif stale_ids and has_credential:
+            app.logger.info(f"Cache miss or expired for {len(stale_ids)} subscriptions, refreshing in background")
+            job_id = refresh_scheduler.refresh(stale_ids)
+
+        # Unchanged data since the client's last poll: answer without a body
+        etag, last_modified, not_modified = check_conditional(subscription_ids, stream=stream)
+        if not_modified and not force_refresh:
+            return set_cache_headers(not_modified_response(etag, last_modified), stale_ids, as_of, job_id, partial_ids)
+
+        if stream:
+            # One JSON document per line, subscription by subscription, straight
+            # from the stored rows; limit doesn't apply to streams
+            def generate():
+                for subscription_id in subscription_ids:
+                    subscription_query = query.filter(VMCache.subscription_id == subscription_id)
+                    for cached_vm in subscription_query.yield_per(VM_STREAM_BATCH_SIZE):
+                        yield cached_vm.data + '\n'
+
+            response = app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+            set_conditional_headers(response, etag, last_modified)
+            return set_cache_headers(response, stale_ids, as_of, job_id, partial_ids), 202 if force_refresh else 200
+
+        next_cursor = None
+        if limit is not None:
+            rows = query.limit(limit + 1).all()
+            if len(rows) > limit:
+                rows = rows[:limit]
+                last_row = rows[-1]
+                next_cursor = encode_cursor(getattr(last_row, sort) or '', last_row.id)
+        else:
+            rows = query.all()
+
+        all_vms = []
+        for cached_vm in rows:
+            try:
+                all_vms.append(json.loads(cached_vm.data))
+            except json.JSONDecodeError as e:
+                app.logger.error(f"Error decoding cached VM data: {str(e)}")
                 continue
 
         app.logger.info(f"Returning {len(all_vms)} total VMs")
-        return jsonify(all_vms)
+        response = set_cache_headers(jsonify(all_vms), stale_ids, as_of, job_id, partial_ids)
+        set_conditional_headers(response, etag, last_modified)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 202 if force_refresh else 200
 
     except Exception as e:
         app.logger.error(f"Error fetching VMs: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/refresh-jobs/<job_id>')
+def get_refresh_job(job_id):
+    job = refresh_scheduler.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Refresh job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/events')
+def stream_events():
+    # Server-sent events for the selected subscriptions and /api/vms filters:
+    # 'ready' on connect (pages load /api/vms then), a 'kpi' snapshot per
+    # subscription, then 'vms' and 'kpi' whenever a sync changes something and
+    # 'reset' when the page should reload instead. types (comma-separated vms,
+    # kpi) limits the stream to the events a page uses.
+    listener = None
+    types = request.args.get('types', ','.join(EVENT_TYPES)).split(',')
+    if any(event_type not in EVENT_TYPES for event_type in types):
+        return jsonify({'error': f"types must be a comma-separated list of {', '.join(EVENT_TYPES)}"}), 400
+    try:
+        subscription_ids = get_subscription_ids()
+        filters = {column: request.args[column].lower() for column in EVENT_FILTERS if request.args.get(column)}
+        # Listening before the snapshot is read, so no change falls in between
+        listener = change_broker.listen(subscription_ids, filters, types)
+        if listener is None:
+            app.logger.warning(f"Refusing event stream: {EVENT_STREAM_MAX_LISTENERS} streams already open")
+            response = jsonify({'error': 'Too many open event streams, poll instead'})
+            response.headers['Retry-After'] = str(EVENT_STREAM_RETRY_AFTER)
+            return response, 503
+        aggregates = load_kpi_aggregates(subscription_ids) if 'kpi' in types else {}
+    except Exception as e:
+        app.logger.error(f"Error opening event stream: {str(e)}")
+        if listener is not None:
+            change_broker.close(listener)
+        return jsonify({'error': str(e)}), 500
+
+    def kpi_snapshot(aggregates):
+        for subscription_id, counts in aggregates.items():
+            yield format_event('kpi', {'subscription_id': subscription_id, 'counts': counts})
+
+    # Runs without an app context, so no database session stays open while the page is
+    def generate():
+        yield format_event('ready', {'subscription_ids': subscription_ids})
+        yield from kpi_snapshot(aggregates)
+        while True:
+            if listener.overflowed:
+                listener.overflowed = False
+                while not listener.queue.empty():
+                    listener.queue.get_nowait()
+                yield format_event('reset', {})
+                # The dropped events may have carried KPI counts
+                if 'kpi' in types:
+                    with app.app_context():
+                        latest = load_kpi_aggregates(subscription_ids)
+                    yield from kpi_snapshot(latest)
+                continue
+            try:
+                name, data = listener.queue.get(timeout=EVENT_STREAM_KEEPALIVE)
+            except queue.Empty:
+                # Keeps proxies from closing an idle stream
+                yield ': keepalive\n\n'
+                continue
+            yield format_event(name, data)
+
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    # Called by the server when the page disconnects, whether or not the stream started
+    response.call_on_close(lambda: change_broker.close(listener))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @app.route('/kpi')
 def kpi():
     return render_template('kpi.html')
@@ -425,69 +2238,342 @@ def kpi():
 @app.route('/api/kpi')
 def get_kpi():
     try:
-        all_vms = []
-        for sub in get_subscriptions():
-            try:
-                credential = get_azure_credential()
-                compute_client = ComputeManagementClient(credential, sub['id'])
-                vms = fetch_and_cache_vms(compute_client, sub['id'])
-                all_vms.extend(vms)
-            except Exception as e:
-                app.logger.error(f"Error fetching VMs for subscription {sub['id']}: {str(e)}")
-                continue
+        subscription_ids = get_subscription_ids()
 
-        if not all_vms:
-            return jsonify({
-                'total_vms': 0,
-                'running_vms': 0,
-                'stopped_vms': 0,
-                'total_cost': 0,
-                'regions': {},
-                'vm_sizes': {}
-            })
+        # Served from the materialized aggregates; stale subscriptions are
+        # refreshed in the background like /api/vms
+        has_credential = check_refresh_credential()
+        stale_ids, as_of, partial_ids = check_cache_freshness(subscription_ids)
+        job_id = refresh_scheduler.refresh(stale_ids) if stale_ids and has_credential else None
 
-        # Calculate KPIs
-        total_vms = len(all_vms)
-        running_vms = sum(1 for vm in all_vms if vm['status'].lower() == 'running')
-        stopped_vms = sum(1 for vm in all_vms if vm['status'].lower() in ['stopped', 'deallocated'])
-        
-        # Region distribution
+        etag, last_modified, not_modified = check_conditional(subscription_ids)
+        if not_modified:
+            return set_cache_headers(not_modified_response(etag, last_modified), stale_ids, as_of, job_id, partial_ids)
+
+        aggregates = load_kpi_aggregates(subscription_ids)
+
+        power = {}
         regions = {}
-        for vm in all_vms:
-            region = vm['location']
-            regions[region] = regions.get(region, 0) + 1
-            
-        # VM size distribution
         vm_sizes = {}
-        for vm in all_vms:
-            size = vm['vm_size']
-            vm_sizes[size] = vm_sizes.get(size, 0) + 1
+        subscriptions = {}
+        for subscription_id, counts in aggregates.items():
+            for totals, dimension in ((power, 'power'), (regions, 'region'), (vm_sizes, 'size')):
+                for key, count in counts[dimension].items():
+                    totals[key] = totals.get(key, 0) + count
+            subscriptions[subscription_id] = {
+                'total_vms': sum(counts['power'].values()),
+                'running_vms': counts['power'].get('running', 0),
+                'stopped_vms': counts['power'].get('stopped', 0)
+            }
 
-        return jsonify({
-            'total_vms': total_vms,
-            'running_vms': running_vms,
-            'stopped_vms': stopped_vms,
+        response = jsonify({
+            'total_vms': sum(power.values()),
+            'running_vms': power.get('running', 0),
+            'stopped_vms': power.get('stopped', 0),
             'regions': regions,
-            'vm_sizes': vm_sizes
+            'vm_sizes': vm_sizes,
+            'subscriptions': subscriptions
         })
+        set_conditional_headers(response, etag, last_modified)
+        return set_cache_headers(response, stale_ids, as_of, job_id, partial_ids)
 
     except Exception as e:
         app.logger.error(f"Error calculating KPIs: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/kpi/trend')
+def get_kpi_trend():
+    # Hourly VM counts over the last `hours`, summed from the per-location
+    # history rows, so it reaches back KPI_HISTORY_HOURLY_RETENTION at most
+    try:
+        subscription_ids = get_subscription_ids()
+        hours = request.args.get('hours', 24, type=int)
+        since = datetime.now(timezone.utc) - timedelta(hours=hours)
+        rows = (
+            db.session.query(KPIHistory.bucket_start, KPIHistory.power, db.func.sum(KPIHistory.count))
+            .filter(
+                KPIHistory.resolution == 'hour',
+                KPIHistory.dimension == 'location',
+                KPIHistory.bucket_start >= get_history_bucket_start(since, 'hour'),
+                KPIHistory.subscription_id.in_(subscription_ids)
+            )
+            .group_by(KPIHistory.bucket_start, KPIHistory.power)
+            .order_by(KPIHistory.bucket_start)
+            .all()
+        )
+        buckets = {}
+        for bucket_start, power, count in rows:
+            bucket_start = as_utc(bucket_start)
+            bucket = buckets.get(bucket_start)
+            if bucket is None:
+                bucket = buckets[bucket_start] = {
+                    'bucket_start': bucket_start.isoformat(),
+                    'total_vms': 0,
+                    'running_vms': 0,
+                    'stopped_vms': 0
+                }
+            bucket['total_vms'] += count
+            if power in ('running', 'stopped'):
+                bucket[f"{power}_vms"] += count
+        return jsonify(list(buckets.values()))
+
+    except Exception as e:
+        app.logger.error(f"Error fetching KPI trend: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+HISTORY_GROUPS = ('location', 'power', 'vm_size')
+
+def parse_history_time(value, default):
+    if not value:
+        return default
+    moment = datetime.fromisoformat(value)
+    # Stored buckets are UTC, and SQLite compares them without their offset
+    return moment.astimezone(timezone.utc) if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+@app.route('/api/kpi/history')
+def get_kpi_history():
+    # VM counts per bucket between start and end (ISO 8601, default the last
+    # 7 days), optionally narrowed by power (running, stopped, other) and one of
+    # location or vm_size, and broken down by one of them with group_by. Hourly
+    # buckets are used for ranges of up to two days still within their retention.
+    try:
+        now = datetime.now(timezone.utc)
+        try:
+            end = parse_history_time(request.args.get('end'), now)
+            start = parse_history_time(request.args.get('start'), end - timedelta(days=7))
+        except ValueError:
+            return jsonify({'error': 'start and end must be ISO 8601 timestamps'}), 400
+        resolution = request.args.get('resolution', 'auto')
+        if resolution == 'auto':
+            hourly = end - start <= timedelta(days=2) and start >= now - KPI_HISTORY_HOURLY_RETENTION
+            resolution = 'hour' if hourly else 'day'
+        if resolution not in HISTORY_RESOLUTIONS:
+            return jsonify({'error': f"Invalid resolution: {resolution}"}), 400
+        group_by = request.args.get('group_by')
+        if group_by and group_by not in HISTORY_GROUPS:
+            return jsonify({'error': f"Invalid group_by: {group_by}"}), 400
+        location = request.args.get('location')
+        vm_size = request.args.get('vm_size')
+        power = request.args.get('power')
+        # Counts are kept by location and by size, not by both
+        if location and (vm_size or group_by == 'vm_size') or vm_size and group_by == 'location':
+            return jsonify({'error': 'location and vm_size cannot be combined'}), 400
+        dimension = 'vm_size' if vm_size or group_by == 'vm_size' else 'location'
+
+        subscription_ids = get_subscription_ids()
+        filters = [
+            KPIHistory.resolution == resolution,
+            KPIHistory.dimension == dimension,
+            KPIHistory.bucket_start >= get_history_bucket_start(start, resolution),
+            KPIHistory.bucket_start <= end,
+            KPIHistory.subscription_id.in_(subscription_ids)
+        ]
+        if location or vm_size:
+            filters.append(db.func.lower(KPIHistory.key) == (location or vm_size).lower())
+        if power:
+            filters.append(KPIHistory.power == power.lower())
+
+        group_columns = [KPIHistory.bucket_start, KPIHistory.power]
+        if group_by in ('location', 'vm_size'):
+            group_columns.append(KPIHistory.key)
+        rows = (
+            db.session.query(*group_columns, db.func.sum(KPIHistory.count))
+            .filter(*filters)
+            .group_by(*group_columns)
+            .order_by(KPIHistory.bucket_start)
+            .all()
+        )
+        buckets = {}
+        for row in rows:
+            bucket_start, row_power, count = as_utc(row[0]), row[1], row[-1]
+            bucket = buckets.get(bucket_start)
+            if bucket is None:
+                bucket = buckets[bucket_start] = {
+                    'bucket_start': bucket_start.isoformat(),
+                    'total_vms': 0,
+                    'running_vms': 0,
+                    'stopped_vms': 0
+                }
+                if group_by:
+                    bucket['groups'] = {}
+            bucket['total_vms'] += count
+            if row_power in ('running', 'stopped'):
+                bucket[f"{row_power}_vms"] += count
+            if group_by:
+                group = row_power if group_by == 'power' else row[2]
+                bucket['groups'][group] = bucket['groups'].get(group, 0) + count
+
+        return jsonify({
+            'resolution': resolution,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'buckets': list(buckets.values())
+        })
+
+    except Exception as e:
+        app.logger.error(f"Error fetching KPI history: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/vms/history')
+def get_vm_history():
+    # State changes logged for one VM, oldest first
+    vm_id = request.args.get('vm_id')
+    if not vm_id:
+        return jsonify({'error': 'vm_id is required'}), 400
+    try:
+        changes = (
+            VMStateChange.query
+            .filter(VMStateChange.vm_id == vm_id.lower())
+            .order_by(VMStateChange.changed_at, VMStateChange.id)
+            .all()
+        )
+        return jsonify([
+            {
+                'changed_at': as_utc(change.changed_at).isoformat(),
+                'change_type': change.change_type,
+                'status': change.status,
+                'vm_size': change.vm_size,
+                'location': change.location
+            }
+            for change in changes
+        ])
+    except Exception as e:
+        app.logger.error(f"Error fetching VM history: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/network')
+def network():
+    return render_template('network.html')
+
+@app.route('/storage')
+def storage():
+    return render_template('storage.html')
+
+def get_inventory_response(response_keys):
+    # Serves inventory types, keyed by their name in the response, from
+    # InventoryCache; stale subscriptions are refreshed in the background by the
+    # same crawl that fills VMCache
+    subscription_ids = get_subscription_ids()
+    has_credential = check_refresh_credential()
+    stale_ids, as_of, partial_ids = check_cache_freshness(subscription_ids)
+    job_id = refresh_scheduler.refresh(stale_ids) if stale_ids and has_credential else None
+
+    etag, last_modified, not_modified = check_conditional(subscription_ids, InventoryCache)
+    if not_modified:
+        return set_cache_headers(not_modified_response(etag, last_modified), stale_ids, as_of, job_id, partial_ids)
+
+    query = InventoryCache.query.filter(
+        InventoryCache.subscription_id.in_(subscription_ids),
+        InventoryCache.resource_type.in_(list(response_keys))
+    )
+    # Resources attached to one VM (its NICs, public IPs and disks)
+    vm_id = request.args.get('vm_id')
+    if vm_id:
+        query = query.filter(InventoryCache.vm_id == vm_id.lower())
+
+    inventory = {key: [] for key in response_keys.values()}
+    for row in query.order_by(InventoryCache.subscription_id, InventoryCache.resource_type, InventoryCache.name):
+        try:
+            inventory[response_keys[row.resource_type]].append(json.loads(row.data))
+        except json.JSONDecodeError as e:
+            app.logger.error(f"Error decoding cached inventory data: {str(e)}")
+            continue
+
+    response = jsonify(inventory)
+    set_conditional_headers(response, etag, last_modified)
+    return set_cache_headers(response, stale_ids, as_of, job_id, partial_ids)
+
+@app.route('/api/network-data')
+def get_network_data():
+    try:
+        return get_inventory_response({
+            'virtual_network': 'vnets',
+            'network_security_group': 'nsgs',
+            'network_interface': 'network_interfaces',
+            'public_ip_address': 'public_ips'
+        })
+    except Exception as e:
+        app.logger.error(f"Error fetching network data: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/storage-data')
+def get_storage_data():
+    try:
+        return get_inventory_response({
+            'storage_account': 'storage_accounts',
+            'disk': 'disks'
+        })
+    except Exception as e:
+        app.logger.error(f"Error fetching storage data: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/metrics')
+def metrics():
+    return app.response_class(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
 @app.route('/api/logout', methods=['POST'])
 def logout():
     try:
         # Clear the database cache
         db.session.query(VMCache).delete()
+        db.session.query(VMSyncState).delete()
+        db.session.query(KPIAggregate).delete()
+        db.session.query(KPIHistory).delete()
+        db.session.query(VMStateChange).delete()
+        db.session.query(InventoryCache).delete()
         db.session.query(SubscriptionCache).delete()
         db.session.commit()
         
         # Run Azure CLI logout
         os.system('az logout')
+
+        # Drop the cached credential and the clients built on it
+        client_pool.clear()
+        credential_holder.reset()
+        subscription_store.clear()
+        arm_rate_limiter.clear()
+        if query_cache is not None:
+            query_cache.clear()
         return jsonify({'status': 'success'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def load_azure_classes():
+    for name in AZURE_CLASSES:
+        azure_class(name)
+
+def warm_up():
+    # Run in each worker before it accepts requests: probes the credential and renders WARMUP_PATHS so the subscription and
+    # query caches are filled before the first real request
+    started = time.perf_counter()
+    load_azure_classes()
+    with app.app_context():
+        get_subscriptions()
+    client = app.test_client()
+    for path in WARMUP_PATHS:
+        try:
+            response = client.get(path)
+            app.logger.info(f"Warmed up {path}: {response.status_code}")
+        except Exception as e:
+            app.logger.error(f"Error warming up {path}: {str(e)}")
+    app.logger.info(f"Warm-up finished in {time.perf_counter() - started:.2f}s")
+
+def create_app():
+    # Entry point for WSGI servers (wsgi.py), called once in each worker
+    # process. Routes are registered on the module-level app at import; this
+    # starts what the serving process owns and warms it up.
+    if BACKGROUND_REFRESH_ENABLED:
+        refresh_scheduler.start()
+    if WARMUP_ENABLED:
+        warm_up()
+    return app
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    with app.app_context():
+        create_cache_schema()
+    debug = os.getenv('FLASK_DEBUG', 'true').lower() in ('1', 'true')
+    # Under the debug reloader skip its parent process, so only the serving
+    # process crawls; without it this is the serving process
+    if BACKGROUND_REFRESH_ENABLED and (not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        refresh_scheduler.start()
+    app.run(debug=debug)
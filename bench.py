@@ -0,0 +1,190 @@
+# Offline benchmark of the crawl, sync and API paths against a simulated ARM
+# backend (fake_azure.FakeAzureFleet). Each fleet size runs in its own process
+# with a fresh SQLite database, so peak RSS and timings don't bleed over.
+#
+#   python bench.py                          # 100, 1k, 10k and 50k VMs
+#   python bench.py --sizes 1000 --latency-ms 50 --throttle-rate 0.05
+#   python bench.py --sizes 10000 --concurrency 32 --quota 25,250
+#   python bench.py --json bench_output.json
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_SIZES = '100,1000,10000,50000'
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_fleet(args):
+    # Configured before app is imported: app reads its settings at import time
+    database = os.path.join(tempfile.mkdtemp(prefix='azboard-bench-'), 'bench.db')
+    os.environ['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{database}"
+    os.environ['AZURE_MAX_CONCURRENCY'] = str(args.concurrency)
+
+    import logging
+    import app as azboard
+    from fake_azure import FakeAzureFleet
+    from sqlalchemy import event
+
+    # Per-VM info logging would dominate the timings
+    azboard.app.logger.setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    fleet = FakeAzureFleet(
+        args.size,
+        subscriptions=args.subscriptions,
+        latency=args.latency_ms / 1000,
+        page_size=args.page_size,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        seed=args.seed,
+        quota=tuple(float(value) for value in args.quota.split(',')) if args.quota else None
+    )
+    fleet.install(azboard)
+
+    writes = {'statements': 0, 'rows': 0}
+
+    def count_writes(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+            writes['statements'] += 1
+            writes['rows'] += max(cursor.rowcount, 0)
+
+    with azboard.app.app_context():
+        azboard.create_cache_schema()
+        event.listen(azboard.db.engine, 'after_cursor_execute', count_writes)
+
+    subscription_ids = [sub.subscription_id for sub in fleet.subscriptions]
+    client = azboard.app.test_client()
+    results = []
+
+    def measure(name, func):
+        calls_before = sum(fleet.calls.values()) + fleet.resource_graph.queries
+        throttled_before = fleet.throttled
+        writes_before = dict(writes)
+        started = time.perf_counter()
+        detail = func()
+        results.append({
+            'fleet': args.size,
+            'scenario': name,
+            'wall_s': round(time.perf_counter() - started, 3),
+            'arm_calls': sum(fleet.calls.values()) + fleet.resource_graph.queries - calls_before,
+            'throttled': fleet.throttled - throttled_before,
+            'db_statements': writes['statements'] - writes_before['statements'],
+            'db_rows': writes['rows'] - writes_before['rows'],
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'detail': detail
+        })
+
+    def refresh(full):
+        job_id = azboard.refresh_scheduler.refresh(subscription_ids, full=full)
+        while True:
+            job = azboard.refresh_scheduler.get_job(job_id)
+            if job['status'] != 'running':
+                return job['status']
+            time.sleep(0.01)
+
+    def fetch_and_cache():
+        with azboard.app.app_context():
+            return sum(
+                len(azboard.fetch_and_cache_vms(azboard.get_compute_client(subscription_id), subscription_id))
+                for subscription_id in subscription_ids
+            )
+
+    def churn_and_sync():
+        changed = fleet.churn(args.churn)
+        status = refresh(False)
+        return f"{changed} changed, {status}"
+
+    def get(url, headers=None):
+        def request():
+            response = client.get(url, headers=headers)
+            body = response.get_data()
+            return f"{response.status_code}, {len(body)} bytes"
+        return request
+
+    measure('subscriptions', get('/api/subscriptions'))
+    measure('full_crawl', lambda: refresh(True))
+    measure('fetch_and_cache_vms', fetch_and_cache)
+    measure('delta_sync', churn_and_sync)
+    measure('api_vms', get('/api/vms'))
+    measure('api_vms_cached', get('/api/vms'))
+    measure('api_vms_gzip', get('/api/vms', {'Accept-Encoding': 'gzip'}))
+    measure('api_vms_gzip_cached', get('/api/vms', {'Accept-Encoding': 'gzip'}))
+    measure('api_vms_filtered', get('/api/vms?location=westeurope&status=VM%20running'))
+    measure('api_vms_page', get('/api/vms?limit=100&sort=name'))
+    measure('api_vms_stream', get('/api/vms?stream=true'))
+    measure('api_vms_304', get('/api/vms', {'If-None-Match': client.get('/api/vms').headers.get('ETag', '')}))
+    measure('api_kpi', get('/api/kpi'))
+    measure('api_network_data', get('/api/network-data'))
+    measure('api_storage_data', get('/api/storage-data'))
+    measure('api_kpi_trend', get('/api/kpi/trend?hours=24'))
+
+    azboard.subscription_executor.shutdown(wait=True)
+    azboard.list_executor.shutdown(wait=True)
+    return results
+
+
+def print_table(results):
+    columns = ['fleet', 'scenario', 'wall_s', 'arm_calls', 'throttled', 'db_statements', 'db_rows', 'peak_rss_mb', 'detail']
+    widths = {column: max(len(column), *(len(str(row[column])) for row in results)) for column in columns}
+    print('  '.join(column.ljust(widths[column]) for column in columns))
+    for row in results:
+        print('  '.join(str(row[column]).ljust(widths[column]) for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark AZBoard against a simulated Azure tenant')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma separated fleet sizes')
+    parser.add_argument('--subscriptions', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=20, help='simulated latency of each ARM call')
+    parser.add_argument('--page-size', type=int, default=1000, help='items per ARM list page')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of ARM calls answered with a 429')
+    parser.add_argument('--retry-after', type=float, default=0.1, help='Retry-After seconds on injected 429s')
+    parser.add_argument('--quota', help="simulate ARM's read quota per subscription as RATE,BURST (e.g. 25,250)")
+    parser.add_argument('--concurrency', type=int, default=8, help='AZURE_MAX_CONCURRENCY for the run')
+    parser.add_argument('--churn', type=float, default=0.01, help='fraction of VMs changed before the delta sync')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.size is not None:
+        # Child process: one fleet size, results as JSON on stdout
+        json.dump(run_fleet(args), sys.stdout)
+        return
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        command = [
+            sys.executable, __file__, '--size', str(size),
+            '--subscriptions', str(args.subscriptions),
+            '--latency-ms', str(args.latency_ms),
+            '--page-size', str(args.page_size),
+            '--throttle-rate', str(args.throttle_rate),
+            '--retry-after', str(args.retry_after),
+            '--concurrency', str(args.concurrency),
+            '--churn', str(args.churn),
+            '--seed', str(args.seed)
+        ]
+        if args.quota:
+            command += ['--quota', args.quota]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.extend(json.loads(output))
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,454 @@
+# In-memory stand-ins for the Azure management clients used by app.py, for
+# exercising the sync and cache code and benchmarking it without a live tenant.
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from functools import partial
+from types import SimpleNamespace
+
+from azure.core.exceptions import HttpResponseError
+
+LOCATIONS = ['eastus', 'westus2', 'westeurope', 'northeurope', 'uksouth', 'southeastasia']
+VM_SIZES = ['Standard_B2s', 'Standard_D2s_v3', 'Standard_D4s_v3', 'Standard_D8s_v3',
+            'Standard_E4s_v3', 'Standard_F4s_v2', 'Standard_B1ms', 'Standard_DS1_v2']
+POWER_STATES = [('PowerState/running', 'VM running')] * 7 + [
+    ('PowerState/deallocated', 'VM deallocated'),
+    ('PowerState/stopped', 'VM stopped')
+]
+
+
+# Answers the resourcechanges queries issued by app.query_resource_changes from
+# a local change log. Only the subscription and changeTime filters are honoured.
+class FakeResourceGraphClient:
+    def __init__(self, changes=None, page_size=1000):
+        self.changes = list(changes or [])
+        self.page_size = page_size
+        self.queries = 0
+
+    def record_change(self, resource_id, change_type='Update', change_time=None):
+        parts = resource_id.lower().split('/')
+        self.changes.append({
+            'subscriptionId': parts[2],
+            'targetResourceId': resource_id.lower(),
+            'targetResourceType': f"{parts[6]}/{parts[7]}",
+            'changeType': change_type,
+            'changeTime': change_time or datetime.now(timezone.utc)
+        })
+
+    def resources(self, query):
+        self.queries += 1
+        since = datetime.fromisoformat(re.search(r"changeTime > datetime\(([^)]+)\)", query.query).group(1))
+        matches = [
+            {key: value for key, value in change.items() if key != 'subscriptionId'}
+            for change in self.changes
+            if change['subscriptionId'] in query.subscriptions and change['changeTime'] > since
+        ]
+        offset = int(query.options.skip_token or 0) if query.options else 0
+        page = matches[offset:offset + self.page_size]
+        next_offset = offset + self.page_size
+        return SimpleNamespace(
+            data=page,
+            skip_token=str(next_offset) if next_offset < len(matches) else None
+        )
+
+# A simulated tenant: `vm_count` VMs spread over `subscriptions` subscriptions,
+# each with one NIC, an OS disk and every other one with a public IP, plus a
+# VNet, NSG and storage account per resource group. Every list page and
+# point read counts as one ARM call in `calls`, sleeps `latency` seconds and is
+# throttled with a 429 at `throttle_rate`, like the real management plane.
+# With `quota` (reads per second, burst) each subscription, and the tenant for
+# the subscription listing, also gets ARM's token bucket: calls report what is
+# left in x-ms-ratelimit-remaining-*-reads and get a 429 once it is empty.
+class FakeAzureFleet:
+    def __init__(self, vm_count, subscriptions=1, latency=0.0, page_size=1000,
+                 throttle_rate=0.0, retry_after=0, resource_groups=20, seed=0, quota=None):
+        self.latency = latency
+        self.page_size = page_size
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.quota = quota
+        self._quota_buckets = {}
+        self.calls = Counter()
+        self.throttled = 0
+        self.resource_groups = resource_groups
+        self.vm_count = vm_count
+        self.resource_graph = FakeResourceGraphClient(page_size=page_size)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self.subscriptions = [
+            SimpleNamespace(
+                subscription_id=f"00000000-0000-0000-0000-{index:012d}",
+                display_name=f"Benchmark Subscription {index}",
+                state='Enabled'
+            )
+            for index in range(subscriptions)
+        ]
+        # Per subscription: resource ID (lowercase) -> resource
+        self.vms = {sub.subscription_id: {} for sub in self.subscriptions}
+        self.nics = {sub.subscription_id: {} for sub in self.subscriptions}
+        self.public_ips = {sub.subscription_id: {} for sub in self.subscriptions}
+        self.virtual_networks = {sub.subscription_id: {} for sub in self.subscriptions}
+        self.network_security_groups = {sub.subscription_id: {} for sub in self.subscriptions}
+        self.disks = {sub.subscription_id: {} for sub in self.subscriptions}
+        self.storage_accounts = {sub.subscription_id: {} for sub in self.subscriptions}
+        self.power_states = {}
+        for index in range(vm_count):
+            self._add_vm(self.subscriptions[index % subscriptions].subscription_id, index, resource_groups)
+
+    def _add_resource_group(self, subscription_id, group_id, location):
+        group = group_id.split('/')[-1]
+        vnet_id = f"{group_id}/providers/Microsoft.Network/virtualNetworks/vnet-{group}"
+        nsg_id = f"{group_id}/providers/Microsoft.Network/networkSecurityGroups/nsg-{group}"
+        subnet_id = f"{vnet_id}/subnets/default"
+        self.virtual_networks[subscription_id][vnet_id.lower()] = SimpleNamespace(
+            id=vnet_id,
+            name=f"vnet-{group}",
+            location=location,
+            address_space=SimpleNamespace(address_prefixes=['10.0.0.0/8']),
+            subnets=[SimpleNamespace(
+                id=subnet_id,
+                name='default',
+                address_prefix='10.0.0.0/16',
+                address_prefixes=None,
+                network_security_group=SimpleNamespace(id=nsg_id)
+            )],
+            dhcp_options=None
+        )
+        self.network_security_groups[subscription_id][nsg_id.lower()] = SimpleNamespace(
+            id=nsg_id,
+            name=f"nsg-{group}",
+            location=location,
+            security_rules=[SimpleNamespace(
+                name='allow-https',
+                priority=100,
+                access='Allow',
+                direction='Inbound',
+                protocol='Tcp',
+                source_address_prefix='*',
+                destination_port_range='443'
+            )],
+            subnets=[SimpleNamespace(id=subnet_id)],
+            network_interfaces=[]
+        )
+        account_name = f"st{subscription_id[-6:]}{group.replace('-', '')}"
+        account_id = f"{group_id}/providers/Microsoft.Storage/storageAccounts/{account_name}"
+        self.storage_accounts[subscription_id][account_id.lower()] = SimpleNamespace(
+            id=account_id,
+            name=account_name,
+            location=location,
+            sku=SimpleNamespace(name='Standard_LRS'),
+            kind='StorageV2',
+            access_tier='Hot',
+            status_of_primary='available',
+            primary_endpoints=SimpleNamespace(
+                blob=f"https://{account_name}.blob.core.windows.net/",
+                queue=None, table=None, web=None, dfs=None,
+                file=f"https://{account_name}.file.core.windows.net/"
+            )
+        )
+
+    def _add_vm(self, subscription_id, index, resource_groups, name=None):
+        group_id = f"/subscriptions/{subscription_id}/resourceGroups/rg-{index % resource_groups:03d}"
+        name = name or f"vm-{index:06d}"
+        location = LOCATIONS[index % len(LOCATIONS)]
+        vm_id = f"{group_id}/providers/Microsoft.Compute/virtualMachines/{name}"
+        nic_id = f"{group_id}/providers/Microsoft.Network/networkInterfaces/{name}-nic"
+        disk_id = f"{group_id}/providers/Microsoft.Compute/disks/{name}-osdisk"
+        vnet_id = f"{group_id}/providers/Microsoft.Network/virtualNetworks/vnet-{group_id.split('/')[-1]}"
+        if vnet_id.lower() not in self.virtual_networks[subscription_id]:
+            self._add_resource_group(subscription_id, group_id, location)
+        subnet_id = f"{vnet_id}/subnets/default"
+
+        public_ip_ref = None
+        if index % 2 == 0:
+            public_ip_id = f"{group_id}/providers/Microsoft.Network/publicIPAddresses/{name}-ip"
+            self.public_ips[subscription_id][public_ip_id.lower()] = SimpleNamespace(
+                id=public_ip_id,
+                name=f"{name}-ip",
+                location=location,
+                ip_address=f"20.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}",
+                sku=SimpleNamespace(name='Standard'),
+                public_ip_allocation_method='Static',
+                ip_configuration=SimpleNamespace(id=f"{nic_id}/ipConfigurations/ipconfig1")
+            )
+            # NIC listings only carry a reference to the public IP, not its address
+            public_ip_ref = SimpleNamespace(id=public_ip_id, ip_address=None)
+
+        self.nics[subscription_id][nic_id.lower()] = SimpleNamespace(
+            id=nic_id,
+            name=f"{name}-nic",
+            location=location,
+            mac_address=f"00-0D-3A-{index >> 16 & 255:02X}-{index >> 8 & 255:02X}-{index & 255:02X}",
+            virtual_machine=SimpleNamespace(id=vm_id),
+            network_security_group=None,
+            ip_configurations=[SimpleNamespace(
+                name='ipconfig1',
+                private_ip_address=f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}",
+                public_ip_address=public_ip_ref,
+                subnet=SimpleNamespace(id=subnet_id)
+            )]
+        )
+        self.disks[subscription_id][disk_id.lower()] = SimpleNamespace(
+            id=disk_id,
+            name=f"{name}-osdisk",
+            location=location,
+            sku=SimpleNamespace(name='Premium_LRS'),
+            disk_size_gb=128,
+            disk_state='Attached',
+            os_type='Windows' if index % 3 == 0 else 'Linux',
+            managed_by=vm_id
+        )
+        self.vms[subscription_id][vm_id.lower()] = SimpleNamespace(
+            id=vm_id,
+            name=name,
+            location=location,
+            hardware_profile=SimpleNamespace(vm_size=VM_SIZES[index % len(VM_SIZES)]),
+            storage_profile=SimpleNamespace(os_disk=SimpleNamespace(os_type='Windows' if index % 3 == 0 else 'Linux')),
+            network_profile=SimpleNamespace(network_interfaces=[SimpleNamespace(id=nic_id)]),
+            instance_view=None
+        )
+        self.power_states[vm_id.lower()] = POWER_STATES[index % len(POWER_STATES)]
+        return vm_id
+
+    def _take_quota(self, scope):
+        # Returns the reads left in the scope's bucket and, when it is empty,
+        # the seconds until the next one
+        rate, burst = self.quota
+        now = time.monotonic()
+        tokens, updated = self._quota_buckets.get(scope, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens < 1:
+            self._quota_buckets[scope] = (tokens, now)
+            return 0, (1 - tokens) / rate
+        self._quota_buckets[scope] = (tokens - 1, now)
+        return int(tokens - 1), 0
+
+    def call(self, operation, scope='tenant', policies=()):
+        # One HTTP request. scope is the calling client's subscription ID, or
+        # 'tenant'; policies are its per_retry_policies.
+        for policy in policies:
+            policy.on_request(None)
+        headers = {}
+        with self._lock:
+            self.calls[operation] += 1
+            throttled = self.throttle_rate and self._random.random() < self.throttle_rate
+            retry_after = self.retry_after
+            if self.quota:
+                remaining, wait = self._take_quota(scope)
+                headers[f"x-ms-ratelimit-remaining-{'tenant' if scope == 'tenant' else 'subscription'}-reads"] = str(remaining)
+                if wait:
+                    throttled = True
+                    retry_after = wait
+            if throttled:
+                self.throttled += 1
+                headers['Retry-After'] = str(retry_after)
+        if self.latency:
+            time.sleep(self.latency)
+        response = SimpleNamespace(status_code=429 if throttled else 200, headers=headers)
+        for policy in policies:
+            policy.on_response(None, SimpleNamespace(http_response=response))
+        if throttled:
+            error = HttpResponseError(message=f"Too many requests for {operation}")
+            error.status_code = 429
+            error.response = response
+            raise error
+
+    def pages(self, operation, items, pipeline):
+        # Items are handed out a page at a time, so a 429 can cut a listing short
+        items = list(items)
+        for offset in range(0, max(len(items), 1), self.page_size):
+            pipeline.call(operation)
+            yield from items[offset:offset + self.page_size]
+
+    def lookup(self, operation, resources, resource_id, pipeline):
+        pipeline.call(operation)
+        resource = resources.get(resource_id.lower())
+        if resource is None:
+            error = HttpResponseError(message=f"Resource {resource_id} not found")
+            error.status_code = 404
+            raise error
+        return resource
+
+    def instance_view(self, vm):
+        code, display_status = self.power_states[vm.id.lower()]
+        return SimpleNamespace(id=vm.id, name=vm.name, instance_view=SimpleNamespace(statuses=[
+            SimpleNamespace(code='ProvisioningState/succeeded', display_status='Provisioning succeeded'),
+            SimpleNamespace(code=code, display_status=display_status)
+        ]))
+
+    def churn(self, fraction, resize_fraction=0.1):
+        # Flips the power state of `fraction` of the fleet and resizes a share of
+        # those, recording the resizes in the Resource Graph change log
+        vm_ids = sorted(self.power_states)
+        changed = self._random.sample(vm_ids, int(len(vm_ids) * fraction))
+        for vm_id in changed:
+            running = self.power_states[vm_id][0] == 'PowerState/running'
+            self.power_states[vm_id] = POWER_STATES[-2] if running else POWER_STATES[0]
+            if self._random.random() < resize_fraction:
+                vm = self.vms[vm_id.split('/')[2]][vm_id]
+                vm.hardware_profile = SimpleNamespace(vm_size=self._random.choice(VM_SIZES))
+                self.resource_graph.record_change(vm.id)
+        return len(changed)
+
+    # Single changes to the fleet, recorded in the Resource Graph change log like
+    # Azure does; power state changes are not, as with real change tracking
+    def create_vm(self, subscription_id, name=None):
+        vm_id = self._add_vm(subscription_id, self.vm_count, self.resource_groups, name)
+        self.vm_count += 1
+        self.resource_graph.record_change(vm_id, 'Create')
+        return vm_id
+
+    def delete_vm(self, vm_id):
+        vm = self.vms[vm_id.split('/')[2]].pop(vm_id.lower())
+        del self.power_states[vm_id.lower()]
+        self.resource_graph.record_change(vm.id, 'Delete')
+
+    def resize_vm(self, vm_id, vm_size):
+        vm = self.vms[vm_id.split('/')[2]][vm_id.lower()]
+        vm.hardware_profile = SimpleNamespace(vm_size=vm_size)
+        self.resource_graph.record_change(vm.id)
+
+    def set_power_state(self, vm_id, running):
+        self.power_states[vm_id.lower()] = POWER_STATES[0] if running else POWER_STATES[-2]
+
+    def install(self, module):
+        # Points app.py's client classes and credentials at this fleet
+        module.DefaultAzureCredential = FakeCredential
+        module.AzureCliCredential = FakeCredential
+        module.ComputeManagementClient = partial(FakeComputeManagementClient, self)
+        module.NetworkManagementClient = partial(FakeNetworkManagementClient, self)
+        module.SubscriptionClient = partial(FakeSubscriptionClient, self)
+        module.StorageManagementClient = partial(FakeStorageManagementClient, self)
+        module.ResourceGraphClient = lambda credential, **kwargs: self.resource_graph
+        module.client_pool.clear()
+        module.credential_holder.reset()
+        module.subscription_store.clear()
+        module.arm_rate_limiter.clear()
+
+
+# A fake client's request pipeline: like azure-core's, it runs the client's
+# per_retry_policies around every attempt and retries 429s after Retry-After,
+# up to retry_total times
+class _FakePipeline:
+    def __init__(self, fleet, scope, per_retry_policies=(), retry_total=10, **kwargs):
+        self.fleet = fleet
+        self.scope = scope
+        self.policies = per_retry_policies
+        self.retry_total = retry_total
+
+    def call(self, operation):
+        for attempt in range(self.retry_total + 1):
+            try:
+                return self.fleet.call(operation, self.scope, self.policies)
+            except HttpResponseError as e:
+                if e.status_code != 429 or attempt == self.retry_total:
+                    raise
+                time.sleep(float(e.response.headers['Retry-After']))
+
+
+class FakeCredential:
+    def get_token(self, *scopes, **kwargs):
+        return SimpleNamespace(token='fake-token', expires_on=int(time.time()) + 3600)
+
+    def close(self):
+        pass
+
+
+class _FakeVirtualMachines:
+    def __init__(self, fleet, subscription_id, pipeline):
+        self.fleet = fleet
+        self.subscription_id = subscription_id
+        self.pipeline = pipeline
+
+    def list_all(self, status_only=None):
+        vms = self.fleet.vms[self.subscription_id].values()
+        if status_only:
+            return self.fleet.pages('virtual_machines.list_all_status', map(self.fleet.instance_view, vms), self.pipeline)
+        return self.fleet.pages('virtual_machines.list_all', vms, self.pipeline)
+
+    def get(self, resource_group_name, vm_name):
+        vm_id = f"/subscriptions/{self.subscription_id}/resourceGroups/{resource_group_name}/providers/Microsoft.Compute/virtualMachines/{vm_name}"
+        return self.fleet.lookup('virtual_machines.get', self.fleet.vms[self.subscription_id], vm_id, self.pipeline)
+
+
+class _FakeResources:
+    def __init__(self, fleet, subscription_id, pipeline, operation, resources, provider):
+        self.fleet = fleet
+        self.subscription_id = subscription_id
+        self.pipeline = pipeline
+        self.operation = operation
+        self.resources = resources
+        self.provider = provider
+
+    def list_all(self):
+        return self.fleet.pages(f"{self.operation}.list_all", self.resources.values(), self.pipeline)
+
+    def list(self):
+        return self.fleet.pages(f"{self.operation}.list", self.resources.values(), self.pipeline)
+
+    def get(self, resource_group_name, name):
+        resource_id = f"/subscriptions/{self.subscription_id}/resourceGroups/{resource_group_name}/providers/{self.provider}/{name}"
+        return self.fleet.lookup(f"{self.operation}.get", self.resources, resource_id, self.pipeline)
+
+
+class FakeComputeManagementClient:
+    def __init__(self, fleet, credential, subscription_id, **kwargs):
+        pipeline = _FakePipeline(fleet, subscription_id, **kwargs)
+        self.virtual_machines = _FakeVirtualMachines(fleet, subscription_id, pipeline)
+        self.disks = _FakeResources(
+            fleet, subscription_id, pipeline, 'disks',
+            fleet.disks[subscription_id], 'Microsoft.Compute/disks'
+        )
+
+    def close(self):
+        pass
+
+
+class FakeNetworkManagementClient:
+    def __init__(self, fleet, credential, subscription_id, **kwargs):
+        pipeline = _FakePipeline(fleet, subscription_id, **kwargs)
+        self.network_interfaces = _FakeResources(
+            fleet, subscription_id, pipeline, 'network_interfaces',
+            fleet.nics[subscription_id], 'Microsoft.Network/networkInterfaces'
+        )
+        self.public_ip_addresses = _FakeResources(
+            fleet, subscription_id, pipeline, 'public_ip_addresses',
+            fleet.public_ips[subscription_id], 'Microsoft.Network/publicIPAddresses'
+        )
+        self.virtual_networks = _FakeResources(
+            fleet, subscription_id, pipeline, 'virtual_networks',
+            fleet.virtual_networks[subscription_id], 'Microsoft.Network/virtualNetworks'
+        )
+        self.network_security_groups = _FakeResources(
+            fleet, subscription_id, pipeline, 'network_security_groups',
+            fleet.network_security_groups[subscription_id], 'Microsoft.Network/networkSecurityGroups'
+        )
+
+    def close(self):
+        pass
+
+
+class FakeStorageManagementClient:
+    def __init__(self, fleet, credential, subscription_id, **kwargs):
+        pipeline = _FakePipeline(fleet, subscription_id, **kwargs)
+        self.storage_accounts = _FakeResources(
+            fleet, subscription_id, pipeline, 'storage_accounts',
+            fleet.storage_accounts[subscription_id], 'Microsoft.Storage/storageAccounts'
+        )
+
+    def close(self):
+        pass
+
+
+class FakeSubscriptionClient:
+    def __init__(self, fleet, credential, **kwargs):
+        self.fleet = fleet
+        pipeline = _FakePipeline(fleet, 'tenant', **kwargs)
+        self.subscriptions = SimpleNamespace(list=lambda: fleet.pages('subscriptions.list', fleet.subscriptions, pipeline))
+
+    def close(self):
+        pass
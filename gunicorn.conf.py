@@ -0,0 +1,33 @@
+# Production server configuration:
+#   flask --app app init-db   (or let on_starting below do it)
+#   gunicorn -c gunicorn.conf.py wsgi:application
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+# Each worker keeps its own caches and refresh scheduler; to run more than one,
+# set BACKGROUND_REFRESH_ENABLED=false, start `flask --app app refresh-worker`
+# separately and share the query cache through QUERY_CACHE_REDIS_URL
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
+# Requests mostly wait on the database or Azure, so each worker serves them from
+# threads; every open /api/events stream holds one, up to EVENT_STREAM_MAX_LISTENERS
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 32))
+# Streaming /api/vms for a large fleet can take longer than gunicorn's default 30s
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+accesslog = '-'
+
+
+def on_starting(server):
+    # Runs once in the master before any worker is forked: creates the schema
+    # and imports the Azure SDK so workers inherit it instead of each importing it
+    import app
+
+    with app.app.app_context():
+        app.create_cache_schema()
+        # Workers must not share the master's database connections
+        app.db.engine.dispose()
+    app.load_azure_classes()
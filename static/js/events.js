@@ -0,0 +1,43 @@
+// Server-sent change events from /api/events, shared by the pages that show live data.
+// handlers are keyed by event name:
+//   ready - sent on every (re)connect; load the initial data here
+//   vms   - {subscription_id, upserted: [vm], removed: [lowercased vm id]}
+//   kpi   - {subscription_id, counts: {power, region, size}}
+//   reset - too many changes to send one by one; reload
+// params.types ('vms', 'kpi' or 'vms,kpi') limits the stream to those events.
+// The browser reconnects on its own if the stream drops. A refused stream (503
+// when the server has no room for more) is not retried by the browser, so the
+// page falls back to reloading through ready every STREAM_RETRY_MS while it
+// keeps trying to connect.
+const STREAM_RETRY_MS = 30000;
+
+function subscribeToChanges(params, handlers) {
+    const query = new URLSearchParams(params);
+    const subscription = {
+        source: null,
+        retryTimer: null,
+        close() {
+            clearTimeout(this.retryTimer);
+            this.source.close();
+        }
+    };
+
+    function connect() {
+        const source = subscription.source = new EventSource(`/api/events?${query}`);
+        Object.entries(handlers).forEach(([name, handler]) => {
+            source.addEventListener(name, event => handler(JSON.parse(event.data)));
+        });
+        source.addEventListener('error', () => {
+            if (source.readyState !== EventSource.CLOSED) {
+                return;
+            }
+            if (handlers.ready) {
+                handlers.ready({});
+            }
+            subscription.retryTimer = setTimeout(connect, STREAM_RETRY_MS);
+        });
+    }
+
+    connect();
+    return subscription;
+}
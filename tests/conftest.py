@@ -0,0 +1,41 @@
+# Runs app.py against a simulated tenant (fake_azure.py) and a throwaway
+# SQLite database; app.py reads its configuration at import
+import os
+import sys
+import tempfile
+
+import pytest
+
+os.environ['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tempfile.mkdtemp()}/azure_cache.db"
+os.environ['BACKGROUND_REFRESH_ENABLED'] = 'false'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as azboard
+from fake_azure import FakeAzureFleet
+
+
+@pytest.fixture
+def fleet():
+    fleet = FakeAzureFleet(20, subscriptions=2)
+    fleet.install(azboard)
+    with azboard.app.app_context():
+        azboard.db.drop_all()
+        azboard.create_cache_schema()
+    azboard.query_cache.clear()
+    return fleet
+
+
+@pytest.fixture
+def client(fleet):
+    return azboard.app.test_client()
+
+
+@pytest.fixture
+def sync(fleet):
+    # Syncs the subscriptions (all by default) in the foreground; the first
+    # sync of a subscription is a full crawl, later ones are delta syncs
+    def sync(*subscription_ids, full=False):
+        with azboard.app.app_context():
+            for subscription_id in subscription_ids or [sub.subscription_id for sub in fleet.subscriptions]:
+                azboard.sync_subscription_vms(subscription_id, full=full)
+    return sync
@@ -0,0 +1,90 @@
+import time
+
+from prometheus_client import REGISTRY
+
+import app as azboard
+
+
+def metric(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def get_all_pages(client, limit, between_pages=None):
+    names = []
+    response = client.get(f"/api/vms?limit={limit}")
+    while True:
+        names.extend(vm['name'] for vm in response.get_json())
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            return names
+        if between_pages:
+            between_pages()
+            between_pages = None
+        response = client.get(f"/api/vms?limit={limit}&cursor={cursor}")
+
+
+def test_vms_are_served_from_the_cache(fleet, sync, client):
+    sync()
+    response = client.get('/api/vms')
+    assert response.status_code == 200
+    assert len(response.get_json()) == 20
+    assert response.headers['X-Cache-Stale'] == 'false'
+
+
+def test_cursor_pages_are_stable_across_inserts(fleet, sync, client):
+    sync()
+    expected = sorted(vm.name for vms in fleet.vms.values() for vm in vms.values())
+    assert get_all_pages(client, 6) == expected
+
+    # VMs inserted between two pages, before and after the cursor, neither
+    # repeat nor shift the remaining pages
+    subscription_id = fleet.subscriptions[0].subscription_id
+    def insert():
+        fleet.create_vm(subscription_id, name='vm-000000a')
+        fleet.create_vm(subscription_id, name='vm-zzz')
+        sync(subscription_id)
+    names = get_all_pages(client, 6, insert)
+    assert names == expected + ['vm-zzz']
+
+
+def test_conditional_get_after_a_delete(fleet, sync, client):
+    sync()
+    response = client.get('/api/vms')
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+    assert client.get('/api/vms', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/api/vms', headers={'If-Modified-Since': last_modified}).status_code == 304
+
+    # Last-Modified has one-second resolution
+    time.sleep(1)
+    subscription_id = fleet.subscriptions[0].subscription_id
+    fleet.delete_vm(sorted(fleet.vms[subscription_id])[0])
+    sync(subscription_id)
+
+    response = client.get('/api/vms', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert len(response.get_json()) == 19
+    response = client.get('/api/vms', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 200
+    assert len(response.get_json()) == 19
+
+
+def test_etag_depends_on_the_representation(fleet, sync, client):
+    sync()
+    etag = client.get('/api/vms').headers['ETag']
+    response = client.get('/api/vms', headers={'Accept': 'application/x-ndjson', 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert 'Accept' in response.headers['Vary']
+
+
+def test_query_cache_is_invalidated_by_a_sync(fleet, sync, client):
+    sync()
+    client.get('/api/vms')
+    hits = metric('azboard_query_cache_lookups_total', result='hit')
+    assert len(client.get('/api/vms').get_json()) == 20
+    assert metric('azboard_query_cache_lookups_total', result='hit') == hits + 1
+
+    subscription_id = fleet.subscriptions[0].subscription_id
+    fleet.delete_vm(sorted(fleet.vms[subscription_id])[0])
+    sync(subscription_id)
+    assert len(client.get('/api/vms').get_json()) == 19
+    assert metric('azboard_query_cache_lookups_total', result='hit') == hits + 1
@@ -0,0 +1,59 @@
+import pytest
+from azure.core.exceptions import HttpResponseError
+
+import app as azboard
+from fake_azure import FakeAzureFleet
+
+
+def test_token_bucket_spends_its_burst_then_waits():
+    bucket = azboard.TokenBucket(10, 5)
+    now = bucket.updated
+    assert [bucket.take(now) for _ in range(5)] == [0] * 5
+    assert bucket.take(now) == pytest.approx(0.1)
+    # Refills at the configured rate
+    assert bucket.take(now + 0.2) == 0
+
+
+def test_token_bucket_pauses_and_slows_down_on_429():
+    bucket = azboard.TokenBucket(10, 5)
+    now = bucket.updated
+    bucket.throttle(now, 2)
+    assert bucket.take(now + 1) == pytest.approx(1)
+    assert bucket.rate == 5
+    # Recovers gradually while ARM reports headroom
+    bucket.observe(5)
+    assert 5 < bucket.rate < 10
+
+
+def test_limiter_follows_remaining_quota_headers():
+    limiter = azboard.ArmRateLimiter({'subscription': (10, 100), 'tenant': (10, 100), 'resource_graph': (1, 5)})
+    limiter.observe('sub', 200, {'x-ms-ratelimit-remaining-subscription-reads': '3'})
+    bucket = limiter._bucket('sub')
+    assert bucket.tokens == 3 - bucket.reserve
+    limiter.observe('sub', 429, {'Retry-After': '7'})
+    assert bucket.take(bucket.updated) >= 6
+
+
+def crawl(fleet):
+    fleet.install(azboard)
+    with azboard.app.app_context():
+        azboard.db.drop_all()
+        azboard.create_cache_schema()
+        return azboard.sync_subscription_vms(fleet.subscriptions[0].subscription_id)
+
+
+def test_crawl_stays_within_the_arm_quota():
+    fleet = FakeAzureFleet(40, page_size=5, quota=(25, 30))
+    assert crawl(fleet) == []
+    assert fleet.throttled == 0
+
+
+def test_crawl_without_the_limiter_is_throttled(monkeypatch):
+    monkeypatch.setattr(azboard, 'ARM_RATE_LIMIT_ENABLED', False)
+    fleet = FakeAzureFleet(40, page_size=5, quota=(25, 5))
+    # Whether the retries absorb the 429s or not, ARM had to reject requests
+    try:
+        crawl(fleet)
+    except HttpResponseError as e:
+        assert e.status_code == 429
+    assert fleet.throttled > 0
@@ -0,0 +1,80 @@
+import json
+
+from prometheus_client import REGISTRY
+
+import app as azboard
+
+
+def metric(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def cached_vms(subscription_id):
+    with azboard.app.app_context():
+        return {
+            cached_vm.id.lower(): json.loads(cached_vm.data)
+            for cached_vm in azboard.VMCache.query.filter_by(subscription_id=subscription_id)
+        }
+
+
+def sync_state(subscription_id):
+    with azboard.app.app_context():
+        return azboard.db.session.get(azboard.VMSyncState, subscription_id)
+
+
+def test_full_crawl_caches_every_vm(fleet, sync):
+    sync()
+    for sub in fleet.subscriptions:
+        vms = cached_vms(sub.subscription_id)
+        assert set(vms) == set(fleet.vms[sub.subscription_id])
+        for vm_id, vm_data in vms.items():
+            assert vm_data['status'] == fleet.power_states[vm_id][1]
+
+
+def test_delta_sync_applies_creates_deletes_resizes_and_power_changes(fleet, sync):
+    subscription_id = fleet.subscriptions[0].subscription_id
+    sync(subscription_id)
+    last_full_sync = sync_state(subscription_id).last_full_sync
+    vm_ids = sorted(fleet.vms[subscription_id])
+
+    created_id = fleet.create_vm(subscription_id).lower()
+    fleet.delete_vm(vm_ids[0])
+    fleet.resize_vm(vm_ids[1], 'Standard_E8s_v3')
+    running = fleet.power_states[vm_ids[2]][0] == 'PowerState/running'
+    fleet.set_power_state(vm_ids[2], not running)
+    sync(subscription_id)
+
+    vms = cached_vms(subscription_id)
+    assert set(vms) == set(fleet.vms[subscription_id])
+    assert created_id in vms
+    assert vm_ids[0] not in vms
+    assert vms[vm_ids[1]]['vm_size'] == 'Standard_E8s_v3'
+    assert vms[vm_ids[2]]['status'] == fleet.power_states[vm_ids[2]][1]
+    # Incremental: no full crawl ran and only the changed VM was read back
+    assert sync_state(subscription_id).last_full_sync == last_full_sync
+    assert fleet.calls['virtual_machines.get'] == 2
+    assert fleet.calls['virtual_machines.list_all'] == 1
+
+
+def test_delta_sync_falls_back_to_full_crawl_when_change_query_fails(fleet, sync):
+    subscription_id = fleet.subscriptions[0].subscription_id
+    sync(subscription_id)
+    last_full_sync = sync_state(subscription_id).last_full_sync
+
+    def forbidden(query):
+        raise Exception('AuthorizationFailed')
+    fleet.resource_graph.resources = forbidden
+    vm_id = sorted(fleet.vms[subscription_id])[0]
+    fleet.resize_vm(vm_id, 'Standard_E8s_v3')
+    fleet.delete_vm(sorted(fleet.vms[subscription_id])[1])
+    failures = metric('azboard_sync_failures_total', subscription_id=subscription_id, mode='delta')
+    fallbacks = metric('azboard_sync_fallbacks_total', subscription_id=subscription_id)
+    sync(subscription_id)
+
+    vms = cached_vms(subscription_id)
+    assert set(vms) == set(fleet.vms[subscription_id])
+    assert vms[vm_id]['vm_size'] == 'Standard_E8s_v3'
+    assert sync_state(subscription_id).last_full_sync > last_full_sync
+    assert fleet.calls['virtual_machines.list_all'] == 2
+    assert metric('azboard_sync_failures_total', subscription_id=subscription_id, mode='delta') == failures
+    assert metric('azboard_sync_fallbacks_total', subscription_id=subscription_id) == fallbacks + 1
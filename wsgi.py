@@ -0,0 +1,5 @@
+# WSGI entry point for production servers:
+#   gunicorn -c gunicorn.conf.py wsgi:application
+from app import create_app
+
+application = create_app()